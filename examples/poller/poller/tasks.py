@@ -26,20 +26,17 @@ def get_user_timeline():
       count=200,                            # number of recent tweets to retrieve
       trim_user=True                        # not interested in who retweeted
     )
-    for tweet_info in tweet_infos:
-      tweet, flag = Tweet.retrieve(
-        from_key=True,
-        flush_if_new=True,
-        **{
-          'id': tweet_info.id,
-          'text': tweet_info.text,
-          'created_at': parse(tweet_info.created_at),
-          'user_handle': user.handle,
-        }
-      )
+    tweets = Tweet.retrieve_many([
+      {
+        'id': tweet_info.id,
+        'text': tweet_info.text,
+        'created_at': parse(tweet_info.created_at),
+        'user_handle': user.handle,
+      }
+      for tweet_info in tweet_infos
+    ])
+    for (tweet, flag), tweet_info in zip(tweets, tweet_infos):
       # we add a new retweet count for this tweet
       tweet.retweet_counts.append(
         RetweetCount(retweet_count=tweet_info.retweet_count)
       )
-
-
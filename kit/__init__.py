@@ -73,7 +73,7 @@ def teardown_handler(func, path=None):
   """Set the teardown handler.
 
   :param func: Must accept three arguments: session, app,
-    session_options
+    session_options (the session's options, along with its ``name``)
   :type func: callable
 
   """
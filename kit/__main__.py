@@ -7,6 +7,7 @@ Usage:
   kit server [-dlp PORT] CONF
   kit worker CONF [(-- [RAW] ...)]
   kit flower CONF [(-- [RAW] ...)]
+  kit stats [-p PORT] CONF
   kit -h | --help | --version
 
 Arguments:
@@ -24,10 +25,12 @@ Options:
 
 from code import interact
 from docopt import docopt
+from json import dumps
 from kit import __version__, get_kit
 from os import getenv, environ, sep
 from os.path import abspath, basename, dirname, join, split, splitext
 from re import findall
+from urllib2 import Request, urlopen, URLError
 
 
 def run_shell(kit):
@@ -118,6 +121,33 @@ def run_flower(kit, raw):
   else:
     kit.celeries[0].start(options)
 
+def run_stats(kit, port):
+  """Print the metrics of the local server and of the Celery workers.
+
+  The server's metrics are fetched from its metrics endpoint (in the
+  Prometheus text format) if it is enabled, each worker's using the
+  ``kit_stats`` remote control command.
+
+  """
+  for conf in kit.config.get('flasks', []):
+    path = conf.get('metrics')
+    if path:
+      url = 'http://127.0.0.1:%s%s' % (port, path)
+      req = Request(url)
+      token = conf.get('metrics_token')
+      if token:
+        req.add_header('Authorization', 'Bearer %s' % (token, ))
+      try:
+        print urlopen(req).read()
+      except URLError as err:
+        print 'No server found at %s (%s)' % (url, err.reason)
+      break
+  for app in kit.celeries:
+    for reply in app.control.broadcast('kit_stats', reply=True, timeout=1):
+      for worker_name, metrics in reply.items():
+        print '# %s' % (worker_name, )
+        print dumps(metrics, indent=2, sort_keys=True)
+
 def main():
   """Command line parser."""
   arguments = docopt(__doc__, version=__version__)
@@ -135,6 +165,8 @@ def main():
     run_worker(kit, raw=arguments['RAW'])
   elif arguments['flower']:
     run_flower(kit, raw=arguments['RAW'])
+  elif arguments['stats']:
+    run_stats(kit, port=int(arguments['--port']))
 
 if __name__ == '__main__':
   main()
@@ -4,17 +4,32 @@
 
 
 from celery import Celery
-from celery.signals import task_postrun
+from celery.signals import task_postrun, task_prerun, worker_process_init
 from celery.task import periodic_task
-from flask import Flask
-from flask.signals import request_tearing_down
+from celery.worker.control import Panel
+from flask import abort, Flask, has_request_context, request, Response
+from flask.signals import request_started, request_tearing_down
+from functools import partial
+from hmac import compare_digest
+from logging import getLogger
+from os import getpid
 from os.path import abspath, dirname, join
-from sqlalchemy import create_engine
-from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DBAPIError, DisconnectionError, SQLAlchemyError
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sys import path as sys_path
+from threading import local
+from time import time
 from yaml import load
 
+try:
+  from os import register_at_fork
+except ImportError:
+  register_at_fork = None
+
+from .util import (Metrics, Profiler, ReplicaRouter, RoutingSession,
+  ShardedSession, start_profile, stop_profile, _cache_stats)
+
 
 class KitError(Exception):
 
@@ -36,8 +51,15 @@ class Kit(object):
   flasks = []
   celeries = []
 
+  #: Metrics of the requests, tasks, sessions and connection pools of this
+  #: process (cf. :class:`kit.util.Metrics`).
+  metrics = Metrics()
+
   _registry = {'flasks': {}, 'celeries': {}}
   _sessions = {}
+  _engines = {} # session name to (engine, metrics labels) tuples
+  _profilers = {}
+  _pid = None
 
   __state = {}
 
@@ -55,6 +77,7 @@ class Kit(object):
 
       elif not self.path:
         self.path = path
+        self._pid = getpid()
 
         with open(path) as handle:
           self.config = load(handle)
@@ -69,6 +92,28 @@ class Kit(object):
         task_postrun.connect(_remove_session)
         request_tearing_down.connect(_remove_session)
 
+        # Profiling and timing handlers
+        task_prerun.connect(_on_start)
+        request_started.connect(_on_start)
+
+        # Fork handlers (the pid is also checked when each request or task
+        # starts, for servers which fork without any hook)
+        worker_process_init.connect(_on_fork)
+        if register_at_fork: # python 3.7+
+          register_at_fork(after_in_child=_on_fork)
+
+        for name, key in [
+          ('hits', 'hits'),
+          ('misses', 'misses'),
+          ('evictions', 'evictions'),
+          ('compute_seconds', 'compute_time'),
+        ]:
+          self.metrics.register(
+            'kit_cache_%s_total' % (name, ),
+            partial(_get_cache_samples, key),
+            kind='counter',
+          )
+
   def __repr__(self):
     return '<Kit %r>' % (self.path, )
 
@@ -100,6 +145,13 @@ class Kit(object):
       flask_app.config.update(
         {k.upper(): v for k, v in conf.get('config', {}).items()}
       )
+      metrics_path = conf.get('metrics')
+      if metrics_path:
+        flask_app.add_url_rule(
+          metrics_path,
+          'kit_metrics',
+          partial(_metrics_view, token=conf.get('metrics_token')),
+        )
       self.flasks.append(flask_app)
       for module in conf['modules']:
         self._registry['flasks'][module] = flask_app
@@ -128,20 +180,67 @@ class Kit(object):
       except KeyError:
         raise KitError('No session %r found' % (session_name, ))
 
-      engine = create_engine(
-        conf.get('url', 'sqlite://'), **conf.get('engine', {})
-      )
-      session = scoped_session(
-        sessionmaker(bind=engine, **conf.get('kwargs', {}))
-      )
+      engines, kwargs = _create_engines(session_name, conf)
+      for engine, labels in engines:
+        self.metrics.watch_pool(engine.pool, **labels)
+        if not _is_in_memory(engine):
+          event.listen(engine, 'connect', _on_connect)
+          event.listen(engine, 'checkout', _on_checkout)
+      session = scoped_session(sessionmaker(**kwargs))
 
       options = conf.get('options', {})
       options.setdefault('commit', False)
       options.setdefault('raise', True)
+      options.setdefault('profile', False)
+      options.setdefault('warmup', 1)
+      options['name'] = session_name
+
+      if options['profile']:
+        profiler_options = options['profile']
+        if not isinstance(profiler_options, dict):
+          profiler_options = {}
+        self._profilers[session_name] = [
+          Profiler(engine, **profiler_options) for engine, _ in engines
+        ]
 
       self._sessions[session_name] = (session, options)
+      self._engines[session_name] = engines
     return self._sessions[session_name][0]
 
+  def check_fork(self):
+    """Reset sessions and connection pools if the process was forked.
+
+    Sessions are usually created when modules are imported, before servers
+    and Celery's prefork pool fork their workers. Each forked process must
+    then discard the sessions and pooled connections it inherited (they
+    share their sockets with the parent's): every session's registry is
+    cleared and its engine given a new pool, which is warmed up with
+    ``warmup`` connections (cf. the session options). The inherited
+    connections are left open, closing them would also close the parent's.
+
+    This is called automatically after forks (on Celery's
+    ``worker_process_init`` signal, and ``os.register_at_fork`` when
+    available) and when each request or task starts. Metrics inherited from
+    the parent are also reset.
+
+    """
+    if self._pid == getpid():
+      return
+    self._pid = getpid()
+    self.metrics.clear()
+    for name, (session, options) in self._sessions.items():
+      engines = self._engines[name]
+      if _is_in_memory(engines[0][0]):
+        continue
+      session.registry.clear()
+      for engine, labels in engines:
+        if _is_in_memory(engine):
+          continue
+        _inherited_pools.append(engine.pool)
+        engine.pool = engine.pool.recreate()
+        self.metrics.watch_pool(engine.pool, **labels)
+        _warm_up(engine, options['warmup'])
+
   def _get_options(self, kind, module_name):
     """Options dictionary for the corresponding app."""
     configs = [
@@ -168,22 +267,41 @@ class Kit(object):
     """Callback on request / task teardown.
 
     Default implementation calls the teardown handler on all the defined
-    sessions.
+    sessions, and records the request's (or task's) duration.
 
     """
-    for session, options in self._sessions.values():
-      self._teardown_handler(session, app, options)
+    for name, (session, options) in self._sessions.items():
+      with self.metrics.timer('kit_session_teardown_seconds', session=name):
+        self._teardown_handler(session, app, options)
+    start = getattr(_starts, 'time', None)
+    if start is not None:
+      _starts.time = None
+      if task is not None:
+        self.metrics.observe(
+          'kit_task_seconds', time() - start, task=task.name
+        )
+      else:
+        self.metrics.observe(
+          'kit_request_seconds', time() - start,
+          app=app.name,
+          endpoint=request.endpoint if has_request_context() else None,
+        )
+    if self._profilers:
+      _log_profile(stop_profile(), task)
 
   @staticmethod
   def _teardown_handler(session, app, session_options):
     """Static method to allow overriding without passing first argument."""
+    name = session_options['name']
     try:
       if session_options['commit']:
-        session.commit()
+        with Kit.metrics.timer('kit_session_commit_seconds', session=name):
+          session.commit()
     except (DBAPIError, SQLAlchemyError) as err:
       if session_options['raise']:
         raise err
-      session.rollback()
+      with Kit.metrics.timer('kit_session_rollback_seconds', session=name):
+        session.rollback()
     finally:
       session.remove()
 
@@ -202,3 +320,188 @@ def _remove_session(sender, *args, **kwargs):
     pass
   else:
     kit.on_teardown(app, task)
+
+def _on_start(sender, *args, **kwargs):
+  """Start timing (and profiling, if enabled) the request or task."""
+  try:
+    kit = Kit()
+  except KitError:            # probably in nosetests
+    pass
+  else:
+    kit.check_fork()
+    _starts.time = time()
+    if kit._profilers:
+      start_profile()
+
+def _log_profile(summary, task=None):
+  """Log a request's or task's profile, warning of N+1 patterns."""
+  if summary is None:
+    return
+  if task is not None:
+    name = task.name
+  elif has_request_context():
+    name = '%s %s' % (request.method, request.path)
+  else:
+    name = 'unknown'
+  _logger.info(
+    '%s: %s statements in %.3fs', name, summary['statements'], summary['time']
+  )
+  for pattern in summary['n_plus_one']:
+    _logger.warning(
+      '%s: N+1 pattern from %s (%s), %s executions of %r',
+      name, pattern['attribute'], pattern['location'], pattern['count'],
+      pattern['statement'],
+    )
+
+def _metrics_view(token=None):
+  """Metrics in the Prometheus text format.
+
+  :param token: if specified, only requests with this bearer token are
+    served. Otherwise, only local clients are.
+  :type token: str
+
+  Note that behind a reverse proxy running on the same host, every request
+  comes from ``127.0.0.1`` and is considered local: a token should then be
+  used.
+
+  """
+  if token:
+    authorization = unicode(request.headers.get('Authorization', u''))
+    if not compare_digest(
+      authorization.encode('utf-8'),
+      (u'Bearer %s' % (token, )).encode('utf-8'),
+    ):
+      abort(404)
+  elif not request.remote_addr in ('127.0.0.1', '::1'):
+    abort(404)
+  return Response(
+    Kit.metrics.to_prometheus(),
+    mimetype='text/plain; version=0.0.4',
+  )
+
+def _get_cache_samples(name):
+  """Cached properties' statistic (e.g. ``hits``) samples."""
+  return [
+    ({'model': model, 'property': varname}, stats[name])
+    for (model, varname), stats in sorted(_cache_stats.items())
+  ]
+
+@Panel.register
+def kit_stats(state):
+  """Celery remote control command returning the worker's metrics."""
+  return Kit.metrics.to_json()
+
+def _on_fork(*args, **kwargs):
+  """Reset the kit's sessions in a newly forked process."""
+  try:
+    kit = Kit()
+  except KitError:            # probably in nosetests
+    pass
+  else:
+    kit.check_fork()
+
+def _on_connect(dbapi_connection, connection_record):
+  """Remember which process opened a connection."""
+  connection_record.info['pid'] = getpid()
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+  """Refuse connections opened by another process.
+
+  Safety net for forks which weren't detected: the pool discards the
+  connection (without closing it, since the parent process still uses it)
+  and checks out a new one.
+
+  """
+  if connection_record.info.get('pid', getpid()) != getpid():
+    _inherited_connections.append(dbapi_connection)
+    connection_record.connection = _InheritedConnection()
+    raise DisconnectionError('Connection opened by another process.')
+
+def _is_in_memory(engine):
+  """In-memory SQLite databases can't be reconnected to without data loss."""
+  return engine.url.drivername.startswith('sqlite') and \
+    engine.url.database in (None, '', ':memory:')
+
+def _create_engines(session_name, conf):
+  """Engines of a session, along with its sessionmaker's keyword arguments.
+
+  :param session_name: the session's name
+  :type session_name: str
+  :param conf: the session's configuration
+  :type conf: dict
+  :rtype: tuple
+
+  Engines are returned as a list of ``(engine, labels)`` tuples (the labels
+  identify each engine's pool in the metrics): the database's followed by
+  its replicas', or each shard's.
+
+  """
+  options = conf.get('engine', {})
+  kwargs = dict(conf.get('kwargs', {}))
+  if 'shards' in conf:
+    if 'replicas' in conf:
+      raise KitError('Sharded session %r can\'t have replicas' % (
+        session_name,
+      ))
+    urls = conf['shards']
+    if not isinstance(urls, dict):
+      urls = dict(enumerate(urls))
+    engines = [
+      (
+        create_engine(urls[shard_id], **options),
+        {'session': session_name, 'shard': str(shard_id)},
+      )
+      for shard_id in sorted(urls)
+    ]
+    kwargs.update(
+      class_=ShardedSession,
+      shards=dict(zip(sorted(urls), [engine for engine, _ in engines])),
+    )
+    return engines, kwargs
+  engines = [
+    (create_engine(conf.get('url', 'sqlite://'), **options),
+     {'session': session_name}),
+  ]
+  for index, url in enumerate(conf.get('replicas', [])):
+    engines.append((
+      create_engine(url, **options),
+      {'session': session_name, 'replica': str(index)},
+    ))
+  kwargs['bind'] = engines[0][0]
+  if len(engines) > 1:
+    kwargs.update(
+      class_=RoutingSession,
+      router=ReplicaRouter(
+        [engine for engine, _ in engines[1:]], **conf.get('routing', {})
+      ),
+    )
+  return engines, kwargs
+
+def _warm_up(engine, n_connections):
+  """Open connections in advance, they are then returned to the pool."""
+  connections = []
+  try:
+    for _ in range(n_connections):
+      connections.append(engine.pool.connect())
+  except (DBAPIError, SQLAlchemyError) as err:
+    _logger.warning('Unable to warm up pool for %s: %s', engine.url, err)
+  finally:
+    for connection in connections:
+      connection.close()
+
+class _InheritedConnection(object):
+
+  """Placeholder for an inherited connection, which the pool won't close."""
+
+  def close(self):
+    pass
+
+#: Pools and connections inherited from the parent process, kept to prevent
+#: their connections from being closed when garbage collected.
+_inherited_pools = []
+_inherited_connections = []
+
+#: Start time of the current request or task.
+_starts = local()
+
+_logger = getLogger(__name__)
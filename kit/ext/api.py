@@ -54,18 +54,38 @@ This view will create the following hooks:
 * ``/houses/<id>/cats``
 * ``/houses/<id>/cats/<position>``
 
+Views can also accept batch writes on their collection route, if the
+corresponding methods are listed in ``batch_methods``: sending a list of models
+to ``/houses`` creates them all at once (``POST``), ``PATCH`` and ``DELETE``
+requests update and delete several models at once. Each of these returns one
+status per item.
+
 These are only two simple ways to add a view. Please refer to the documentation
 for :class:`kit.ext.api.BaseView` for the list of all available options.
 
 """
 
-from flask import Blueprint, jsonify, request
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from contextlib import contextmanager
+from datetime import date, datetime, time as time_, timedelta, tzinfo
+from decimal import Decimal, InvalidOperation
+from hashlib import md5
+from flask import (Blueprint, json, jsonify, request, Response,
+  stream_with_context)
+from json import dumps, loads
+from sqlalchemy import and_, func, or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import class_mapper, Query
+from threading import Lock
 from time import time
+from uuid import UUID, uuid4
 from werkzeug.exceptions import HTTPException
+from werkzeug.http import is_resource_modified
 
-from .orm import Model
-from ..util import make_view, query_to_models, View as _View, _ViewMeta
+from .orm import (Model, models_written, _convert_key, _get_column_converter,
+  _get_key_criterion, _notify_writes)
+from ..util import (get_profile, make_view, query_to_models,
+  query_to_records, LRUCache, ShardedSession, View as _View, _ViewMeta)
 
 
 class APIError(HTTPException):
@@ -169,8 +189,17 @@ class _ApiViewMeta(_ViewMeta):
         '/'.join('<%s>' % k.name for k in class_mapper(model).primary_key)
       )
 
+      batch_methods = dct.get('batch_methods')
+      if batch_methods is None:
+        batch_methods = next(
+          (base.batch_methods for base in bases
+          if hasattr(base, 'batch_methods')),
+          ()
+        )
       dct['rules'] = {
-        collection_route: ['GET', 'POST'],
+        collection_route: ['GET', 'POST'] + sorted(
+          set(batch_methods) & set(['PATCH', 'DELETE'])
+        ),
         model_route: ['GET', 'PUT', 'DELETE'],
       }
 
@@ -199,6 +228,28 @@ class View(_View):
   #: Request parser.
   parser = None
 
+  #: Methods accepting batch writes on the collection route (among ``POST``,
+  #: ``PATCH`` and ``DELETE``, cf. :meth:`post_batch`, :meth:`patch_batch` and
+  #: :meth:`delete_batch`). These must also be allowed in :attr:`methods`.
+  #: Batch writes are disabled by default: a ``DELETE`` request with filters
+  #: can for example delete the entire table. Note also that batch writes
+  #: bypass the model's ``__init__`` and ORM events.
+  batch_methods = frozenset()
+
+  #: Name of the model's column storing its last update time. If specified
+  #: (or if the model has a version counter column), GET responses include
+  #: ``ETag`` and ``Last-Modified`` headers and conditional requests are
+  #: answered with a ``304`` without loading any model (cf.
+  #: :meth:`Parser.get_validators`).
+  updated_column = None
+
+  #: Other model classes whose writes invalidate this view's cached
+  #: responses (cf. :meth:`Parser.jsonify_cached`). Only the view's model and
+  #: the models it has a direct relationship to are tracked by default, list
+  #: here any other model read while serializing (e.g. by properties or
+  #: relationships of related models, when the parser's depth allows it).
+  cache_dependencies = []
+
   #: Which relationship endpoints to create (these allow GET requests).
   #: Can be ``True`` (all relationships) or a list of relationship names.
   #: Only relationships with ``lazy`` set to ``'dynamic'``, ``'select'`` or
@@ -265,18 +316,52 @@ class View(_View):
         )
 
   def get(self, **kwargs):
-    """GET request handler."""
+    """GET request handler.
+
+    Conditional requests are supported when validators are available (cf.
+    :attr:`updated_column`). For a single model, these are computed from the
+    loaded model (so that missing ones always get a 404). Responses are
+    cached if the parser's response cache is enabled (cf.
+    :meth:`Parser.jsonify_cached`).
+
+    """
+    model = None
     if kwargs:
       model = self.__model__.retrieve(from_key=True, **kwargs)
       if not model:
         raise APIError(404, 'Not found')
-      return self.parser.jsonify(model)
-    else:
-      return self.parser.jsonify(self.__model__.q)
+    validators = self.parser.get_validators(
+      self.__model__.q, self.updated_column, instance=model
+    )
+    if validators:
+      etag, last_modified = validators
+      if not is_resource_modified(
+        request.environ, etag=etag, last_modified=last_modified
+      ):
+        return _set_validators(Response(status=304), validators)
+
+    def load():
+      return self.__model__.q if model is None else model
+
+    response = self.parser.jsonify_cached(
+      self.__model__, load, dependencies=self.cache_dependencies
+    )
+    if validators:
+      _set_validators(response, validators)
+    return response
 
   def post(self):
-    """POST request handler."""
-    if not self.validate(json):
+    """POST request handler.
+
+    If the request's JSON is a list, all the models are created at once (cf.
+    :meth:`post_batch`), if ``POST`` is in :attr:`batch_methods`.
+
+    """
+    if isinstance(request.json, list):
+      if not 'POST' in self.batch_methods:
+        raise APIError(405, 'Batch POST not allowed')
+      return self.post_batch(request.json)
+    if not self.validate(request.json):
       raise APIError(400, 'Invalid POST parameters')
     model = self.__model__(**request.json)
     model.flush()
@@ -287,20 +372,207 @@ class View(_View):
     model = self.__model__.retrieve(from_key=True, **kwargs)
     if not model:
       raise APIError(404, 'Not found')
-    if not self.validate(json, model):
+    if not self.validate(request.json, model):
       raise APIError(400, 'Invalid PUT parameters')
     for k, v in request.json.items():
       setattr(model, k, v)
     return self.parser.jsonify(model)
 
+  def patch(self):
+    """PATCH request handler (on the collection route).
+
+    Cf. :meth:`patch_batch`.
+
+    """
+    if not isinstance(request.json, list):
+      raise APIError(400, 'PATCH requires a list of updates')
+    return self.patch_batch(request.json)
+
   def delete(self, **kwargs):
-    """DELETE request handler."""
+    """DELETE request handler.
+
+    On the collection route, the models to delete are specified either by a
+    list of primary keys as JSON or by ``filter`` parameters (cf.
+    :meth:`delete_batch`).
+
+    """
+    if not kwargs:
+      return self.delete_batch(request.json)
     model = self.__model__.retrieve(from_key=True, **kwargs)
     if not model:
       raise APIError(404, 'Not found')
     model.delete()
     return self.parser.jsonify(model)
 
+  def post_batch(self, rows):
+    """Create several models at once.
+
+    :param rows: list of dictionaries of attributes
+    :type rows: list
+    :rtype: Flask response
+
+    Valid rows are inserted with a single ``executemany`` (cf.
+    :meth:`kit.ext.orm.Model.bulk_create`). Unlike single ``POST`` requests,
+    no models are instantiated: the model's ``__init__`` and ORM events are
+    bypassed (column defaults are still applied). Override this method to
+    create models one by one if they are needed. The response contains one
+    status per row (``'created'`` along with the new model's primary key, or
+    ``'invalid'``).
+
+    """
+    model = self.__model__
+    key_names = [k.name for k in class_mapper(model).primary_key]
+    statuses = [
+      {'status': 'created'} if self._is_valid(row) else {'status': 'invalid'}
+      for row in rows
+    ]
+    valid_rows = [
+      row for row, status in zip(rows, statuses)
+      if status['status'] == 'created'
+    ]
+    with self._batch():
+      keys = iter(model.bulk_create(valid_rows, return_keys=True))
+    for status in statuses:
+      if status['status'] == 'created':
+        status['key'] = dict(zip(key_names, next(keys)))
+    return self.parser.jsonify_batch(statuses)
+
+  def patch_batch(self, rows):
+    """Update several models at once.
+
+    :param rows: list of dictionaries of attributes to update, each must
+      include the primary key of the model to update and at least one other
+      attribute.
+    :type rows: list
+    :rtype: Flask response
+
+    Existing models are loaded with a single query (to be passed to
+    :meth:`validate`) and valid updates applied with a single
+    ``executemany`` (cf. :meth:`kit.ext.orm.Model.bulk_update`), which also
+    bypasses ORM events. The response contains one status per row:
+    ``'updated'``, ``'not found'`` or ``'invalid'``.
+
+    """
+    model = self.__model__
+    primary_key = class_mapper(model).primary_key
+    key_names = [k.name for k in primary_key]
+    keys = []
+    for row in rows:
+      try:
+        # converted to match the keys of existing rows
+        key = _convert_key(
+          primary_key, tuple(row[name] for name in key_names)
+        )
+      except (KeyError, TypeError, ValueError):
+        key = None
+      keys.append(key)
+    instances = self._get_instances(k for k in keys if k is not None)
+    statuses = []
+    updates = []
+    for row, key in zip(rows, keys):
+      if key is None:
+        statuses.append({'status': 'invalid'})
+        continue
+      status = {'key': dict(zip(key_names, key))}
+      if not key in instances:
+        status['status'] = 'not found'
+      elif len(row) == len(key_names): # nothing to update
+        status['status'] = 'invalid'
+      elif not self._is_valid(row, instances[key]):
+        status['status'] = 'invalid'
+      else:
+        status['status'] = 'updated'
+        updates.append(dict(row, **status['key']))
+      statuses.append(status)
+    with self._batch():
+      model.bulk_update(updates)
+    return self.parser.jsonify_batch(statuses)
+
+  def delete_batch(self, keys=None):
+    """Delete several models at once.
+
+    :param keys: list of primary keys (dictionaries, or values for models
+      with a single primary key column). If unspecified, the request's
+      ``filter`` parameters are used to select the models to delete.
+    :type keys: list
+    :rtype: Flask response
+
+    Models are deleted with a single ``DELETE`` statement. The response
+    contains one status per key: ``'deleted'`` or ``'not found'``.
+
+    """
+    model = self.__model__
+    primary_key = class_mapper(model).primary_key
+    key_names = [k.name for k in primary_key]
+    key_columns = [getattr(model, name) for name in key_names]
+    if keys is not None:
+      if not isinstance(keys, list):
+        raise APIError(400, 'DELETE requires a list of keys')
+      try:
+        # converted to match the keys of existing rows
+        keys = [
+          _convert_key(
+            primary_key,
+            tuple(key[name] for name in key_names) if isinstance(key, dict)
+            else (key, )
+          )
+          for key in keys
+        ]
+      except (KeyError, ValueError):
+        raise APIError(400, 'Invalid keys')
+      query = model.q.filter(_get_key_criterion(key_columns, keys))
+    else:
+      raw_filters = request.args.getlist('filter')
+      if not raw_filters:
+        raise APIError(400, 'DELETE requires a list of keys or filters')
+      query = self.parser._filter(model.q, model, raw_filters)
+    existing = set(tuple(key) for key in query.with_entities(*key_columns))
+    if keys is None:
+      keys = list(existing)
+    with self._batch():
+      if existing:
+        query.delete(synchronize_session=False)
+        _notify_writes([model], session=query.session)
+    statuses = [
+      {
+        'key': dict(zip(key_names, key)),
+        'status': 'deleted' if key in existing else 'not found',
+      }
+      for key in keys
+    ]
+    return self.parser.jsonify_batch(statuses)
+
+  def _is_valid(self, row, model=None):
+    """Check that a batch row only has columns and call :meth:`validate`."""
+    if not isinstance(row, dict):
+      return False
+    columns = self.__model__._get_columns(show_private=True)
+    return all(key in columns for key in row) and self.validate(row, model)
+
+  def _get_instances(self, keys):
+    """Dictionary of models keyed by primary key tuple, in one query."""
+    keys = list(keys)
+    if not keys:
+      return {}
+    model = self.__model__
+    key_columns = [
+      getattr(model, k.name) for k in class_mapper(model).primary_key
+    ]
+    return dict(
+      (instance.get_primary_key(as_tuple=True), instance)
+      for instance in model.q.filter(_get_key_criterion(key_columns, keys))
+    )
+
+  @contextmanager
+  def _batch(self):
+    """Context manager rolling back the session if a batch write fails."""
+    session = self.__model__.q.session
+    try:
+      yield
+    except IntegrityError as err:
+      session.rollback()
+      raise APIError(400, 'Batch failed: %s' % (err.orig, ))
+
   def validate(self, json, model=None):
     """Validation method.
 
@@ -311,9 +583,10 @@ class View(_View):
     :type model: None or kit.ext.orm.BaseModel
     :rtype: bool
 
-    This method is called on each POST and PUT request. Override it to
-    implement your own validation logic: return ``True`` when the input is
-    valid and ``False`` otherwise. Default implementation accepts everything.
+    This method is called on each POST and PUT request (and for each row of
+    POST and PATCH batches). Override it to implement your own validation
+    logic: return ``True`` when the input is valid and ``False`` otherwise.
+    Default implementation accepts everything.
 
     """
     return True
@@ -365,6 +638,34 @@ class Parser(object):
   :type max_limit: int
   :param sep: the separator used for filters and sort parameters
   :type sep: str
+  :param stream: whether or not to stream collection responses. Instances
+    are then loaded from the database in batches and serialized one at a time
+    so that memory usage stays bounded regardless of the number of results.
+    The metadata is sent after the data.
+  :type stream: bool
+  :param batch_size: number of rows loaded at a time when streaming
+  :type batch_size: int
+  :param count: how to compute the total number of matches of a collection.
+    Either ``'exact'`` or ``'estimate'``. Estimates are read from the
+    database's statistics (cf. :meth:`kit.ext.orm.Query.estimate_count`),
+    and fall back to an exact count when unavailable.
+  :type count: str
+  :param count_ttl: number of seconds counts are cached for. Cached counts of
+    a model are also cleared whenever the model is written to (from this
+    process). ``0`` disables the cache.
+  :type count_ttl: int
+  :param cache_size: maximum number of bytes of serialized responses kept in
+    the in-process response cache (cf. :meth:`jsonify_cached`). ``0``
+    disables the cache.
+  :type cache_size: int
+  :param cache_ttl: number of seconds responses are cached for. ``0`` means
+    responses are only invalidated by writes.
+  :type cache_ttl: int
+  :param cache_backend: optional shared cache (any object implementing
+    werkzeug's cache interface, e.g. ``werkzeug.contrib.cache.RedisCache``)
+    used behind the in-process cache (which defaults to 1MB in that case).
+    Invalidations are then shared across processes.
+  :type cache_backend: werkzeug.contrib.cache.BaseCache
 
   This class has a single method :meth:``jsonify`` which is used to parse a
   model or collection and return the serialized response.
@@ -372,14 +673,38 @@ class Parser(object):
   """
 
   def __init__(self, default_depth=1, max_depth=0, default_limit=20,
-               max_limit=0, sep=';'):
+               max_limit=0, sep=';', stream=False, batch_size=100,
+               count='exact', count_ttl=0, cache_size=0, cache_ttl=0,
+               cache_backend=None):
+    if not count in ['exact', 'estimate']:
+      raise ValueError('Invalid count option: %r' % (count, ))
     self.options = {
       'default_depth': default_depth,
       'max_depth': max_depth,
       'default_limit': default_limit,
       'max_limit': max_limit,
       'sep': sep,
+      'stream': stream,
+      'batch_size': batch_size,
+      'count': count,
+      'count_ttl': count_ttl,
+      'cache_size': cache_size,
+      'cache_ttl': cache_ttl,
     }
+    self._counts = {}
+    self._cache = None
+    self._cache_stats = {'hits': 0, 'misses': 0}
+    self._cache_stats_lock = Lock()
+    self._shared_cache = cache_backend
+    self._generations = {}
+    if cache_size or cache_backend:
+      self._cache = LRUCache(
+        max_size=cache_size or 2 ** 20,
+        ttl=cache_ttl,
+        sizeof=lambda entry: len(entry[0]) + len(entry[1]),
+      )
+    models_written.connect(self._clear_counts)
+    models_written.connect(self._clear_cache)
 
   def jsonify(self, data, data_key='data', meta_key='meta',
     include_request=True, include_time=True, include_matches=True, **kwargs):
@@ -396,7 +721,8 @@ class Parser(object):
     :param include_request: whether or not to include the issued request
       information
     :type include_request: bool
-    :param include_time: whether or not to include processing time
+    :param include_time: whether or not to include processing time (and the
+      SQL profile, cf. :class:`kit.util.Profiler`, if one is active)
     :type include_time: bool
     :param include_matches: whether or not to include the total number of
       results from the data (useful if ``data`` is a collection)
@@ -406,35 +732,326 @@ class Parser(object):
     Any keyword arguments will be included with the metadata.
     
     """
+    depth = self._get_depth()
+    start = time()
+
+    def get_meta(match):
+      return self._get_meta(
+        match, start, include_request, include_time, include_matches, kwargs
+      )
+
+    if self.options['stream'] and not isinstance(data, Model):
+      col, match = self._get_collection(data)
+      return Response(
+        stream_with_context(self._stream(
+          col, match, depth, data_key, meta_key, get_meta
+        )),
+        mimetype='application/json',
+      )
+
+    data, match = self._get_data(data, depth)
+    return jsonify({data_key: data, meta_key: get_meta(match)})
+
+  def jsonify_cached(self, model_class, load, data_key='data',
+    meta_key='meta', include_request=True, include_time=True,
+    include_matches=True, dependencies=None, **kwargs):
+    """Cached version of :meth:`jsonify`.
+
+    :param model_class: the model class of the data. Cached responses are
+      invalidated whenever a model of this class (or of a class it has a
+      direct relationship to) is written to.
+    :type model_class: kit.ext.orm.Model
+    :param load: function returning the data to jsonify, only called if the
+      response isn't cached. Along with the request, this function should
+      always return the same data.
+    :type load: callable
+    :param dependencies: other model classes whose writes also invalidate the
+      response. Tables read while serializing which are neither the model's
+      nor one of its direct relationships' (e.g. through properties, or
+      nested relationships at depths above 1) must be listed here, otherwise
+      stale responses can be served until they expire.
+    :type dependencies: list
+    :rtype: Flask response
+
+    Other arguments are the same as for :meth:`jsonify`. Responses are cached
+    under the request's path and normalized parameters (cf. the ``cache_*``
+    options). The serialized data is cached but the metadata is regenerated
+    on each request and includes the number of cache hits and misses.
+
+    When caching is disabled or responses are streamed, this simply returns
+    ``jsonify(load())``.
+
+    """
+    if self._cache is None or self.options['stream']:
+      return self.jsonify(
+        load(), data_key, meta_key, include_request, include_time,
+        include_matches, **kwargs
+      )
+
+    start = time()
+    key = self._get_cache_key(model_class, dependencies or [])
+    entry = self._cache.get(key)
+    if entry is None and self._shared_cache is not None:
+      entry = self._shared_cache.get(key)
+      if entry is not None:
+        self._cache.set(key, entry)
+    hit = entry is not None
+    with self._cache_stats_lock:
+      self._cache_stats['hits' if hit else 'misses'] += 1
+      cache_stats = dict(self._cache_stats, hit=hit)
+    if hit:
+      data, match = entry
+      match = loads(match)
+    else:
+      data, match = self._get_data(load(), self._get_depth())
+      data = dumps(data)
+      entry = (data, dumps(match))
+      self._cache.set(key, entry)
+      if self._shared_cache is not None:
+        self._shared_cache.set(key, entry, timeout=self.options['cache_ttl'])
+
+    kwargs['cache'] = cache_stats
+    meta = self._get_meta(
+      match, start, include_request, include_time, include_matches, kwargs
+    )
+    return Response(
+      '{%s: %s, %s: %s}' % (
+        dumps(data_key), data, dumps(meta_key), dumps(meta)
+      ),
+      mimetype='application/json',
+    )
+
+  def jsonify_batch(self, statuses, data_key='data', meta_key='meta',
+    include_request=True, **kwargs):
+    """Returns the serialized response of a batch write.
+
+    :param statuses: list of dictionaries, one per item in the batch, each
+      containing at least a ``status`` key
+    :type statuses: list
+    :param data_key: key where the statuses will go
+    :type data_key: str
+    :param meta_key: key where the metadata will go
+    :type meta_key: str
+    :param include_request: whether or not to include the issued request
+      information
+    :type include_request: bool
+    :rtype: Flask response
+
+    The metadata includes the number of items for each status. Any keyword
+    arguments will be included with the metadata as well.
+
+    """
+    counts = {}
+    for status in statuses:
+      counts[status['status']] = counts.get(status['status'], 0) + 1
+    kwargs['statuses'] = counts
+    if include_request:
+      kwargs['request'] = self._get_request_meta()
+    return jsonify({data_key: statuses, meta_key: kwargs})
+
+  def get_validators(self, query, updated_column=None, instance=None):
+    """Cheap validators for the response to a GET request.
+
+    :param query: the query the response will be computed from (the request's
+      filters are applied to it)
+    :type query: kit.ext.orm.Query
+    :param updated_column: name of the model's column storing its last update
+      time
+    :type updated_column: str
+    :param instance: already loaded model the response is computed from. If
+      specified, the validators are computed from its attributes instead of
+      querying (``query`` is then only used to find the model class).
+    :type instance: kit.ext.orm.Model
+    :rtype: tuple
+
+    Returns a tuple ``(etag, last_modified)`` computed from a single aggregate
+    query over the filtered rows: their count, the latest update time and the
+    sum of the version counters (when the model's mapper has a
+    ``version_id_col``). The ETag also depends on the request's path and
+    parameters so that each page of a collection gets its own.
+    ``last_modified`` is ``None`` unless ``updated_column`` is a datetime.
+
+    Returns ``None`` if neither ``updated_column`` nor a version counter are
+    available.
+
+    Note that ``Last-Modified`` alone doesn't account for deleted rows, so
+    clients should prefer ``If-None-Match`` over ``If-Modified-Since``.
+
+    """
+    model = self._get_model_class(query)
+    version_column = class_mapper(model).version_id_col
+    if not updated_column and version_column is None:
+      return None
+    if instance is not None:
+      row = (1, )
+      if updated_column:
+        row += (getattr(instance, updated_column), )
+      if version_column is not None:
+        prop = class_mapper(model).get_property_by_column(version_column)
+        row += (getattr(instance, prop.key), )
+    else:
+      query = self._filter(query, model, request.args.getlist('filter'))
+      aggregates = [func.count()]
+      if updated_column:
+        aggregates.append(func.max(getattr(model, updated_column)))
+      if version_column is not None:
+        aggregates.append(func.sum(version_column))
+      row = tuple(query.order_by(None).with_entities(*aggregates).one())
+    etag = md5(repr((
+      request.path,
+      sorted(request.args.items(multi=True)),
+      row,
+    ))).hexdigest()
+    last_modified = row[1] if updated_column else None
+    if not isinstance(last_modified, datetime):
+      last_modified = None
+    return etag, last_modified
+
+  def _get_depth(self):
+    """Depth to jsonify models to from the request's parameters."""
     depth = request.args.get('depth', self.options['default_depth'], int)
     max_depth = self.options['max_depth']
     if max_depth:
       depth = min(depth, max_depth)
+    return depth
 
-    start = time()
+  def _get_data(self, data, depth):
+    """Serialized data and matches information.
+
+    :param data: model or collection
+    :type data: kit.ext.orm.Model, kit.ext.orm.Query, list
+    :param depth: the depth to jsonify instances to
+    :type depth: int
+    :rtype: tuple
 
+    """
     if isinstance(data, Model):
-      data = data.to_json(depth=depth)
-      match = 1
-    else:
-      col, matches = self._get_collection(data)
-      data = [e.to_json(depth=depth) for e in col if e]
-      match = {'total': matches, 'returned': len(data)}
+      return data.to_json(depth=depth), 1
+    col, match = self._get_collection(data)
+    data = list(self._serialize(col, depth))
+    match['returned'] = len(data)
+    return data, match
+
+  def _get_meta(self, match, start, include_request, include_time,
+    include_matches, kwargs):
+    """Response metadata.
 
-    rv = {data_key: data, meta_key: kwargs}
+    Cursors from the matches information are moved to the top level.
 
+    """
+    meta = kwargs
+    if isinstance(match, dict) and 'cursors' in match:
+      match = dict(match)
+      meta['cursors'] = match.pop('cursors')
     if include_matches:
-      rv[meta_key]['matches'] = match
+      meta['matches'] = match
     if include_request:
-      rv[meta_key]['request'] = {
-        'base_url': request.base_url,
-        'method': request.method,
-        'values': request.values,
-      }
+      meta['request'] = self._get_request_meta()
     if include_time:
-      rv[meta_key]['parsing_time'] = time() - start
+      meta['parsing_time'] = time() - start
+      profile = get_profile()
+      if profile is not None:
+        meta['profile'] = profile
+    return meta
+
+  def _get_request_meta(self):
+    """Information about the issued request, included in the metadata."""
+    return {
+      'base_url': request.base_url,
+      'method': request.method,
+      'values': request.values,
+    }
+
+  def _stream(self, collection, match, depth, data_key, meta_key, get_meta):
+    """Generator of the serialized response's chunks.
+
+    :param collection: the filtered, sorted, offsetted, limited collection
+    :type collection: kit.ext.orm.Query, list
+    :param match: the matches information, ``returned`` will be added
+    :type match: dict
+    :param depth: the depth to jsonify instances to
+    :type depth: int
+    :param get_meta: function that returns the metadata from the match
+    :type get_meta: callable
+    :rtype: generator
+
+    Each chunk contains the serialized instances of one batch, the metadata
+    comes last. Queries are executed with ``stream_results`` so that drivers
+    which support it use server side cursors instead of buffering the whole
+    result set.
+
+    """
+    batch_size = self.options['batch_size']
+    yield '{%s: [' % (json.dumps(data_key), )
+    returned = 0
+    batch = []
+    for instance_json in self._serialize(collection, depth, stream=True):
+      batch.append(json.dumps(instance_json))
+      if len(batch) == batch_size:
+        yield '%s%s' % (',' if returned else '', ','.join(batch))
+        returned += len(batch)
+        batch = []
+    if batch:
+      yield '%s%s' % (',' if returned else '', ','.join(batch))
+      returned += len(batch)
+    match['returned'] = returned
+    yield '], %s: %s}' % (json.dumps(meta_key), json.dumps(get_meta(match)))
+
+  def _serialize(self, collection, depth, stream=False):
+    """Generator of the collection's serialized instances.
+
+    :param collection: the filtered, sorted, offsetted, limited collection
+    :type collection: kit.ext.orm.Query, list
+    :param depth: the depth to jsonify instances to
+    :type depth: int
+    :param stream: whether or not to load rows in batches
+    :type stream: bool
+    :rtype: generator
+
+    When the model's serialized attributes are all columns (or ``depth`` is
+    ``0``), the query is executed directly without loading any instances (in
+    the style of :func:`kit.util.query_to_records`) and the records converted
+    the same way ``to_json`` would (except on sharded sessions, where
+    queries merge rows from several shards). Otherwise instances are loaded
+    and serialized normally.
 
-    return jsonify(rv)
+    """
+    if isinstance(collection, Query):
+      model = self._get_model_class(collection)
+      keys = model._get_json_columns(depth)
+      if keys is not None and not isinstance(collection.session,
+                                             ShardedSession):
+        columns = model._get_columns(show_private=True)
+        converters = [
+          (key, _get_column_converter(columns[key])) for key in keys
+        ]
+        converters = [(key, conv) for key, conv in converters if conv]
+        query = collection.with_entities(*[
+          getattr(model, key).label(key) for key in keys
+        ])
+        if hasattr(query, '_get_connection'):
+          # routed like the query itself (e.g. to a replica)
+          connection = query._get_connection()
+        else:
+          connection = query.session.connection()
+        if stream:
+          connection = connection.execution_options(stream_results=True)
+        for record in query_to_records(query, connection=connection):
+          for key, converter in converters:
+            value = record[key]
+            if value is not None:
+              try:
+                record[key] = converter(value)
+              except ValueError as err:
+                record[key] = err.message
+          yield record
+        return
+      elif stream:
+        collection = collection.execution_options(stream_results=True)
+        collection = collection.yield_per(self.options['batch_size'])
+    for instance in collection:
+      if instance:
+        yield instance.to_json(depth=depth)
 
   def _get_collection(self, collection):
     """Parse query and return JSON.
@@ -446,7 +1063,10 @@ class Parser(object):
     Returns a tuple ``(collection, match)``:
 
     * ``collection`` is the filtered, sorted, offsetted, limited collection.
-    * ``match`` is the total number of results from the filtered query 
+    * ``match`` is a dictionary with the total number of results from the
+      filtered query under ``total``. In cursor mode (when the ``cursor``
+      parameter is passed), the count is skipped and ``match`` instead
+      contains ``has_more`` along with the ``cursors`` to the adjacent pages.
 
     """
     model = self._get_model_class(collection)
@@ -460,48 +1080,20 @@ class Parser(object):
 
     if isinstance(collection, Query):
 
-      sep = self.options['sep']
+      collection = self._filter(collection, model, raw_filters)
+      sorts = self._get_sorts(model, raw_sorts)
 
-      for raw_filter in raw_filters:
-        try:
-          key, op, value = raw_filter.split(sep, 3)
-        except ValueError:
-          raise APIError(400, 'Invalid filter: %s' % raw_filter)
-        column = getattr(model, key, None)
-        if not column: # TODO check if is actual column
-          raise APIError(400, 'Invalid filter column: %s' % key)
-        if op == 'in':
-          filt = column.in_(value.split(','))
-        else:
-          try:
-            attr = filter(
-              lambda e: hasattr(column, e % op),
-              ['%s', '%s_', '__%s__']
-            )[0] % op
-          except IndexError:
-            raise APIError(400, 'Invalid filter operator: %s' % op)
-          if value == 'null':
-            value = None
-          filt = getattr(column, attr)(value)
-        collection = collection.filter(filt)
-
-      for raw_sort in raw_sorts:
-        try:
-          key, order = raw_sort.split(sep)
-        except ValueError:
-          raise APIError(400, 'Invalid sort: %s' % raw_sort)
-        if not order in ['asc', 'desc']:
-          raise APIError(400, 'Invalid sort order: %s' % order)
-        column = getattr(model, key, None)
-        if column:
-          collection = collection.order_by(getattr(column, order)())
-        else:
-          raise APIError(400, 'Invalid sort column: %s' % key)
+      if 'cursor' in request.args:
+        if offset:
+          raise APIError(400, 'Offset and cursor are mutually exclusive')
+        return self._get_page(
+          collection, model, sorts, request.args['cursor'], limit
+        )
 
-      if hasattr(collection, 'fast_count'):
-        matches = collection.fast_count()
-      else:
-        matches = collection.count()
+      for key, column, order in sorts:
+        collection = collection.order_by(getattr(column, order)())
+
+      matches, exact = self._count(collection, model)
       if offset:
         collection = collection.offset(offset)
       if limit:
@@ -510,14 +1102,271 @@ class Parser(object):
     else:
       if raw_filters or raw_sorts:
         raise APIError(400, 'Filter and sorts not implemented for lists')
+      if 'cursor' in request.args:
+        raise APIError(400, 'Cursors not implemented for lists')
 
-      matches = len(collection)
+      matches, exact = len(collection), True
       if limit:
         collection = collection[offset:(offset + limit)]
       else:
         collection = collection[offset:]
 
-    return collection, matches
+    return collection, {'total': matches, 'exact': exact}
+
+  def _count(self, query, model):
+    """Total number of results of a filtered query.
+
+    :param query: the filtered query
+    :type query: kit.ext.orm.Query
+    :param model: the query's model class
+    :type model: kit.ext.orm.Model
+    :rtype: tuple
+
+    Returns a tuple ``(count, exact)``, ``exact`` is ``False`` if the count
+    is an estimate. Counts are cached by model and query criterion (e.g.
+    filters, parent of a relationship) if the ``count_ttl`` option is set.
+    They are cleared when the model's writes are flushed and again when they
+    are committed.
+
+    """
+    ttl = self.options['count_ttl']
+    if ttl:
+      criterion = query._criterion
+      if criterion is None:
+        key = None
+      else:
+        params = criterion.compile().params
+        key = (unicode(criterion), tuple(sorted(params.items())))
+      try:
+        count, exact, expires = self._counts[model][key]
+      except (KeyError, TypeError): # TypeError for unhashable parameters
+        pass
+      else:
+        if expires > time():
+          return count, exact
+
+    count = None
+    if self.options['count'] == 'estimate':
+      if hasattr(query, 'estimate_count'):
+        count = query.estimate_count()
+    exact = count is None
+    if exact:
+      if hasattr(query, 'fast_count'):
+        count = query.fast_count()
+      else:
+        count = query.count()
+
+    if ttl:
+      counts = self._counts.setdefault(model, {})
+      if len(counts) >= 1000:
+        # many different filters, we start over rather than grow unbounded
+        counts.clear()
+      try:
+        counts[key] = (count, exact, time() + ttl)
+      except TypeError:
+        pass
+    return count, exact
+
+  def _clear_counts(self, model, **kwargs):
+    """Signal receiver to clear the counts cached for a model."""
+    self._counts.pop(model, None)
+
+  def _get_cache_key(self, model_class, dependencies):
+    """Response cache key for the current request.
+
+    :param model_class: the model class of the response's data
+    :type model_class: kit.ext.orm.Model
+    :param dependencies: other model classes the response depends on
+    :type dependencies: list
+    :rtype: str
+
+    The key includes the current generation of the model class, of the
+    classes it has a relationship to and of the dependencies, which is
+    changed on each write to invalidate all the corresponding entries.
+
+    """
+    mapper = class_mapper(model_class)
+    tablenames = set([model_class.__tablename__])
+    tablenames.update(
+      rel.mapper.class_.__tablename__ for rel in mapper.relationships
+    )
+    tablenames.update(model.__tablename__ for model in dependencies)
+    return 'kit.api:%s' % md5(repr((
+      request.path,
+      sorted(request.args.items(multi=True)),
+      sorted(
+        (tablename, self._get_generation(tablename))
+        for tablename in tablenames
+      ),
+    ))).hexdigest()
+
+  def _get_generation(self, tablename):
+    """Current cache generation of a table.
+
+    Generations are stored in the shared cache if there is one. A generation
+    missing from it (e.g. evicted) is replaced by a new one, so that entries
+    are never served from an unknown generation.
+
+    """
+    key = 'kit.api.generation:%s' % (tablename, )
+    if self._shared_cache is not None:
+      generation = self._shared_cache.get(key)
+      if generation is None:
+        generation = uuid4().hex
+        self._shared_cache.set(key, generation, timeout=0)
+      return generation
+    return self._generations.setdefault(key, uuid4().hex)
+
+  def _clear_cache(self, model, **kwargs):
+    """Signal receiver to invalidate the responses cached for a model."""
+    if self._cache is not None:
+      key = 'kit.api.generation:%s' % (model.__tablename__, )
+      if self._shared_cache is not None:
+        self._shared_cache.set(key, uuid4().hex, timeout=0)
+      else:
+        self._generations[key] = uuid4().hex
+
+  def _filter(self, query, model, raw_filters):
+    """Apply the request's filters to a query."""
+    sep = self.options['sep']
+    for raw_filter in raw_filters:
+      try:
+        key, op, value = raw_filter.split(sep, 3)
+      except ValueError:
+        raise APIError(400, 'Invalid filter: %s' % raw_filter)
+      column = getattr(model, key, None)
+      if not column: # TODO check if is actual column
+        raise APIError(400, 'Invalid filter column: %s' % key)
+      if op == 'in':
+        filt = column.in_(value.split(','))
+      else:
+        try:
+          attr = filter(
+            lambda e: hasattr(column, e % op),
+            ['%s', '%s_', '__%s__']
+          )[0] % op
+        except IndexError:
+          raise APIError(400, 'Invalid filter operator: %s' % op)
+        if value == 'null':
+          value = None
+        filt = getattr(column, attr)(value)
+      query = query.filter(filt)
+    return query
+
+  def _get_sorts(self, model, raw_sorts):
+    """List of ``(key, column, order)`` tuples from the request's sorts."""
+    sep = self.options['sep']
+    sorts = []
+    for raw_sort in raw_sorts:
+      try:
+        key, order = raw_sort.split(sep)
+      except ValueError:
+        raise APIError(400, 'Invalid sort: %s' % raw_sort)
+      if not order in ['asc', 'desc']:
+        raise APIError(400, 'Invalid sort order: %s' % order)
+      column = getattr(model, key, None)
+      if column:
+        sorts.append((key, column, order))
+      else:
+        raise APIError(400, 'Invalid sort column: %s' % key)
+    return sorts
+
+  def _get_page(self, query, model, sorts, cursor, limit):
+    """Keyset pagination.
+
+    :param query: the filtered query
+    :type query: kit.ext.orm.Query
+    :param model: the query's model class
+    :type model: kit.ext.orm.Model
+    :param sorts: the requested sorts, as returned by :meth:`_get_sorts`
+    :type sorts: list
+    :param cursor: the opaque cursor sent by the client (empty for the first
+      page)
+    :type cursor: str
+    :param limit: the page size
+    :type limit: int
+    :rtype: tuple
+
+    Instead of skipping ``offset`` rows, the page is located by filtering on
+    the values of the sort columns (plus the primary key, to break ties) of
+    the last row seen. With an index on these columns, any page is as cheap
+    to load as the first one. The row count is skipped as well: an extra row
+    is fetched to know whether or not there are more results.
+
+    Any ordering already present on the query is replaced by the requested
+    sorts. Sort columns should not be nullable, and their values must be
+    storable in a cursor: booleans, numbers, strings, dates, times,
+    decimals or UUIDs (other sorts are rejected).
+
+    """
+    sorted_keys = set(key for key, column, order in sorts)
+    sorts = sorts + [
+      (k.name, getattr(model, k.name), 'asc')
+      for k in class_mapper(model).primary_key
+      if not k.name in sorted_keys
+    ]
+    for key, column, order in sorts:
+      try:
+        python_type = column.type.python_type
+      except (AttributeError, NotImplementedError):
+        python_type = None
+      if python_type is None or not issubclass(python_type, _cursor_types):
+        raise APIError(400, 'Unsupported sort for cursors: %s' % key)
+
+    if cursor:
+      try:
+        direction, values = _decode_cursor(cursor)
+      except ValueError:
+        raise APIError(400, 'Invalid cursor: %s' % cursor)
+      if len(values) != len(sorts):
+        raise APIError(400, 'Cursor incompatible with sorts: %s' % cursor)
+    else:
+      direction, values = 'next', None
+
+    if direction == 'prev':
+      # we walk backwards and reverse the results afterwards
+      sorts = [
+        (key, column, 'desc' if order == 'asc' else 'asc')
+        for key, column, order in sorts
+      ]
+
+    query = query.order_by(None).order_by(*[
+      getattr(column, order)() for key, column, order in sorts
+    ])
+    if values is not None:
+      query = query.filter(_get_keyset_filter(sorts, values))
+
+    if limit:
+      instances = query.limit(limit + 1).all()
+      has_more = len(instances) > limit
+      instances = instances[:limit]
+    else:
+      instances = query.all()
+      has_more = False
+
+    def get_cursor(direction, instance):
+      try:
+        return _encode_cursor(
+          direction,
+          [getattr(instance, key) for key, column, order in sorts]
+        )
+      except ValueError as err:
+        raise APIError(400, str(err))
+
+    cursors = {'next': None, 'prev': None}
+    if instances:
+      if direction == 'next':
+        if has_more:
+          cursors['next'] = get_cursor('next', instances[-1])
+        if values is not None:
+          cursors['prev'] = get_cursor('prev', instances[0])
+      else:
+        if has_more:
+          cursors['prev'] = get_cursor('prev', instances[-1])
+        cursors['next'] = get_cursor('next', instances[0])
+        instances.reverse()
+
+    return instances, {'has_more': has_more, 'cursors': cursors}
 
   def _get_model_class(self, collection):
     """Return corresponding model class from collection."""
@@ -538,3 +1387,153 @@ class Parser(object):
     else:
       return collection[0].__class__
 
+
+
+def _set_validators(response, validators):
+  """Add ``ETag`` and ``Last-Modified`` headers to a response.
+
+  :param response: response
+  :type response: Flask response
+  :param validators: tuple ``(etag, last_modified)``
+  :type validators: tuple
+  :rtype: Flask response
+
+  """
+  etag, last_modified = validators
+  response.set_etag(etag)
+  if last_modified:
+    response.last_modified = last_modified
+  return response
+
+def _get_keyset_filter(sorts, values):
+  """Filter selecting the rows strictly after ``values`` in the sort order.
+
+  :param sorts: list of ``(key, column, order)`` tuples
+  :type sorts: list
+  :param values: the sort values of the last row seen
+  :type values: list
+  :rtype: sqlalchemy clause
+
+  This is the expanded form of the row value comparison ``(c1, c2) > (v1,
+  v2)``, which allows mixing ascending and descending orders.
+
+  """
+  clauses = []
+  for index, (key, column, order) in enumerate(sorts):
+    clause = [
+      col == value
+      for (_, col, _), value in zip(sorts[:index], values[:index])
+    ]
+    if order == 'asc':
+      clause.append(column > values[index])
+    else:
+      clause.append(column < values[index])
+    clauses.append(and_(*clause))
+  return or_(*clauses)
+
+def _encode_cursor(direction, values):
+  """Opaque cursor from a direction and sort values.
+
+  Dates and times are stored in ISO format (including any UTC offset).
+  Raises ``ValueError`` for values of other types than ``_cursor_types``.
+
+  """
+  encoded_values = []
+  for value in values:
+    if value is not None and not isinstance(value, _cursor_types):
+      raise ValueError('Unsupported cursor value: %r' % (value, ))
+    for cls, type_name in _cursor_type_names:
+      if isinstance(value, cls):
+        value = {type_name: _cursor_formatters.get(cls, str)(value)}
+        break
+    encoded_values.append(value)
+  return urlsafe_b64encode(dumps([direction, encoded_values]))
+
+def _decode_cursor(cursor):
+  """Inverse of :func:`_encode_cursor`. Raises ``ValueError`` if invalid."""
+  try:
+    direction, values = loads(urlsafe_b64decode(str(cursor)))
+  except (TypeError, ValueError):
+    raise ValueError('Invalid cursor')
+  if not direction in ['next', 'prev'] or not isinstance(values, list):
+    raise ValueError('Invalid cursor')
+  for index, value in enumerate(values):
+    if isinstance(value, dict):
+      ((type_name, raw_value), ) = value.items()
+      if not isinstance(raw_value, basestring):
+        raise ValueError('Invalid cursor')
+      try:
+        values[index] = _cursor_parsers[type_name](raw_value)
+      except (KeyError, TypeError, InvalidOperation):
+        raise ValueError('Invalid cursor')
+  return direction, values
+
+def _parse_datetime(s):
+  """Inverse of ``datetime.isoformat``."""
+  s, offset = _split_utc_offset(s.replace(' ', 'T'))
+  value = datetime.strptime(
+    s, '%Y-%m-%dT%H:%M:%S.%f' if '.' in s else '%Y-%m-%dT%H:%M:%S'
+  )
+  return value.replace(tzinfo=offset)
+
+def _parse_time(s):
+  """Inverse of ``time.isoformat``."""
+  s, offset = _split_utc_offset(s)
+  value = datetime.strptime(s, '%H:%M:%S.%f' if '.' in s else '%H:%M:%S')
+  return value.time().replace(tzinfo=offset)
+
+def _split_utc_offset(s):
+  """Split a trailing ``+HH:MM`` UTC offset from an ISO formatted string.
+
+  The offset is returned as a ``tzinfo`` (``None`` if there is none).
+
+  """
+  if len(s) > 6 and s[-6] in '+-' and s[-3] == ':':
+    minutes = 60 * int(s[-5:-3]) + int(s[-2:])
+    return s[:-6], _FixedOffset(minutes if s[-6] == '+' else -minutes)
+  return s, None
+
+
+class _FixedOffset(tzinfo):
+
+  """Timezone with a fixed offset from UTC, in minutes."""
+
+  def __init__(self, minutes):
+    self._offset = timedelta(minutes=minutes)
+
+  def __repr__(self):
+    return '<_FixedOffset (%s)>' % (self._offset, )
+
+  def utcoffset(self, dt):
+    return self._offset
+
+  def dst(self, dt):
+    return timedelta(0)
+
+
+#: Types of the sort values which can be stored in cursors.
+_cursor_types = (basestring, bool, int, long, float, date, time_, Decimal,
+                 UUID)
+
+# datetime is a subclass of date, it must be checked first
+_cursor_type_names = [
+  (datetime, '$datetime'),
+  (date, '$date'),
+  (time_, '$time'),
+  (Decimal, '$Decimal'),
+  (UUID, '$UUID'),
+]
+
+_cursor_formatters = {
+  datetime: lambda value: value.isoformat(),
+  date: lambda value: value.isoformat(),
+  time_: lambda value: value.isoformat(),
+}
+
+_cursor_parsers = {
+  '$datetime': _parse_datetime,
+  '$date': lambda s: datetime.strptime(s, '%Y-%m-%d').date(),
+  '$time': _parse_time,
+  '$Decimal': Decimal,
+  '$UUID': UUID,
+}
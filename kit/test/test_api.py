@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+
+from base64 import urlsafe_b64encode
+from datetime import datetime, time, timedelta
+from flask import Flask
+from json import dumps, loads
+from nose.tools import assert_raises, eq_, ok_
+from sqlalchemy import (Column, create_engine, DateTime, Integer, String,
+  Unicode)
+from sqlalchemy.orm import scoped_session, sessionmaker
+from uuid import UUID
+
+from kit.ext import API, ORM
+from kit.ext.api import (_convert_key, _decode_cursor, _encode_cursor,
+  _FixedOffset)
+from kit.ext.orm import models_written
+from kit.util import (Profiler, ReplicaRouter, RoutingSession, ShardedSession,
+  start_profile, stop_profile)
+
+
+class _Fixture(object):
+
+  parser_options = {'default_limit': 10}
+  shard_key = None
+
+  def setup(self):
+    session = self.get_session()
+    orm = ORM(session)
+
+    class Cat(orm.Model):
+
+      __shard_key__ = self.shard_key
+
+      id = Column(Integer, primary_key=True)
+      name = Column(Unicode(32))
+      age = Column(Integer)
+      updated = Column(DateTime)
+
+    self.create_tables(orm)
+    for index in range(25):
+      session.add(Cat(
+        id=index,
+        name=u'cat%s' % index,
+        age=index % 4,
+        updated=datetime(2014, 1, 1) + timedelta(minutes=index),
+      ))
+    session.commit()
+
+    # the import name is used by flask to find the blueprint's root path
+    app = Flask('kit')
+    api = API(app, parser_options=self.parser_options)
+
+    class CatView(api.View):
+
+      __model__ = Cat
+      methods = ['GET', 'POST', 'PATCH', 'DELETE']
+      batch_methods = ['POST', 'PATCH', 'DELETE']
+      updated_column = 'updated'
+
+    class OtherCatView(api.View):
+
+      __model__ = Cat
+      base_url = endpoint = 'other_cats'
+      methods = ['GET', 'POST', 'PATCH', 'DELETE']
+
+    api.register(app)
+    self.app = app
+    self.Cat = Cat
+    self.parser = CatView.parser
+    self.client = app.test_client()
+
+  def get(self, url):
+    response = self.client.get(url)
+    eq_(response.status_code, 200)
+    return loads(response.data)
+
+  def get_session(self):
+    engine = create_engine('sqlite://')
+    Profiler(engine)
+    return scoped_session(sessionmaker(bind=engine))
+
+  def create_tables(self, orm):
+    orm.create_all()
+
+
+class _ShardedFixture(_Fixture):
+
+  shard_key = 'id'
+
+  def get_session(self):
+    # fan-out queries use connections from the pool's threads
+    self.engines = [
+      create_engine('sqlite://', connect_args={'check_same_thread': False})
+      for _ in range(2)
+    ]
+    for engine in self.engines:
+      Profiler(engine)
+    return scoped_session(sessionmaker(
+      class_=ShardedSession, shards=dict(enumerate(self.engines))
+    ))
+
+  def create_tables(self, orm):
+    for engine in self.engines:
+      orm.Model.metadata.create_all(engine)
+
+
+class Test_Parser(_Fixture):
+
+  def test_offset_pagination(self):
+    rv = self.get('/api/cats/?offset=20')
+    eq_([cat['id'] for cat in rv['data']], range(20, 25))
+    eq_(rv['meta']['matches'], {'total': 25, 'exact': True, 'returned': 5})
+
+  def test_column_records(self):
+    eq_(self.Cat._get_json_columns(), ['age', 'id', 'name', 'updated'])
+    rv = self.get('/api/cats/?limit=0&sort=id;asc')
+    eq_(rv['data'], [cat.to_json() for cat in self.Cat.q.order_by('id')])
+    rv = self.get('/api/cats/?limit=3&depth=0')
+    eq_(rv['data'], [{'id': 0}, {'id': 1}, {'id': 2}])
+
+  def test_custom_to_json(self):
+    def to_json(cat, depth=1):
+      return dict(super(self.Cat, cat).to_json(depth), extra=True)
+    self.Cat.to_json = to_json
+    eq_(self.Cat._get_json_columns(), None)
+    eq_(self.get('/api/cats/3')['data']['extra'], True)
+    ok_(all(cat['extra'] for cat in self.get('/api/cats/')['data']))
+
+  def test_cursor_pagination(self):
+    url = '/api/cats/?sort=age;desc&cursor=%s'
+    expected = [
+      cat['id']
+      for cat in self.get('/api/cats/?sort=age;desc&sort=id;asc&limit=0')['data']
+    ]
+    rv = self.get(url % '')
+    pages = [rv]
+    while rv['meta']['cursors']['next']:
+      rv = self.get(url % rv['meta']['cursors']['next'])
+      pages.append(rv)
+    eq_(len(pages), 3)
+    eq_([cat['id'] for page in pages for cat in page['data']], expected)
+    ok_(not 'total' in pages[0]['meta']['matches'])
+    eq_(pages[-1]['meta']['matches']['has_more'], False)
+    rv = self.get(url % pages[-1]['meta']['cursors']['prev'])
+    eq_(rv['data'], pages[-2]['data'])
+
+  def test_count_cache(self):
+    self.parser.options['count_ttl'] = 60
+    eq_(self.get('/api/cats/?filter=age;eq;1')['meta']['matches']['total'], 6)
+    self.Cat.q.session.execute('DELETE FROM cats WHERE id = 1') # not tracked
+    eq_(self.get('/api/cats/?filter=age;eq;1')['meta']['matches']['total'], 6)
+    cat = self.Cat.q.get(2)
+    cat.age = 1
+    self.Cat.q.session.commit()
+    eq_(self.get('/api/cats/?filter=age;eq;1')['meta']['matches']['total'], 6)
+    eq_(self.get('/api/cats/?filter=age;eq;2')['meta']['matches']['total'], 5)
+
+  def test_count_before_commit(self):
+    self.parser.options['count_ttl'] = 60
+    url = '/api/cats/?filter=age;eq;1'
+    self.Cat.q.get(2).age = 1
+    self.Cat.q.session.flush()
+    eq_(self.get(url)['meta']['matches']['total'], 7)
+    self.Cat.q.session.execute('DELETE FROM cats WHERE id = 1') # not tracked
+    eq_(self.get(url)['meta']['matches']['total'], 7)
+    self.Cat.q.session.commit()
+    eq_(self.get(url)['meta']['matches']['total'], 6)
+
+  def test_estimated_count(self):
+    self.parser.options['count'] = 'estimate'
+    eq_(
+      self.get('/api/cats/')['meta']['matches'],
+      {'total': 25, 'exact': True, 'returned': 10}
+    )
+    self.Cat.q.session.execute('ANALYZE')
+    self.Cat.q.session.execute('UPDATE sqlite_stat1 SET stat = \'1000 1\'')
+    eq_(
+      self.get('/api/cats/')['meta']['matches'],
+      {'total': 1000, 'exact': False, 'returned': 10}
+    )
+    eq_(self.get('/api/cats/?filter=age;eq;1')['meta']['matches']['total'], 6)
+
+  def test_stream(self):
+    expected = self.get('/api/cats/?limit=0')
+    self.parser.options.update({'stream': True, 'batch_size': 4})
+    rv = self.get('/api/cats/?limit=0')
+    eq_(rv['data'], expected['data'])
+    eq_(rv['meta']['matches'], {'total': 25, 'exact': True, 'returned': 25})
+
+  def test_profile(self):
+    start_profile()
+    try:
+      profile = self.get('/api/cats/?filter=age;eq;1')['meta']['profile']
+    finally:
+      stop_profile()
+    eq_(profile['statements'], 3) # validators, count and select
+    eq_(profile['n_plus_one'], [])
+
+  def test_invalid_cursor(self):
+    eq_(self.client.get('/api/cats/?cursor=abc').status_code, 400)
+    eq_(self.client.get('/api/cats/?cursor=&offset=2').status_code, 400)
+    for value in [{'$Decimal': 'abc'}, {'$datetime': 1}, {'$date': 'abc'}]:
+      cursor = urlsafe_b64encode(dumps(['next', [value, 1]]))
+      eq_(self.client.get('/api/cats/?cursor=%s' % cursor).status_code, 400)
+    eq_(self.client.get('/api/cats/?sort=to_json;asc&cursor=').status_code, 400)
+
+  def test_cursor_values(self):
+    values = [
+      datetime(2014, 1, 1, 12, 30, tzinfo=_FixedOffset(-90)),
+      datetime(2014, 1, 1, 12, 30, 5, 10),
+      time(12, 30, tzinfo=_FixedOffset(60)),
+      UUID('12345678123456781234567812345678'),
+      u'a', 1, None,
+    ]
+    direction, decoded = _decode_cursor(_encode_cursor('prev', values))
+    eq_((direction, decoded), ('prev', values))
+    eq_(decoded[0].utcoffset(), timedelta(minutes=-90))
+    eq_(decoded[1].tzinfo, None)
+    eq_(decoded[2].utcoffset(), timedelta(minutes=60))
+    assert_raises(ValueError, _encode_cursor, 'next', [object()])
+
+
+class Test_View(_Fixture):
+
+  def send(self, method, url, data, status_code=200):
+    response = self.client.open(
+      url,
+      method=method,
+      data=dumps(data),
+      content_type='application/json',
+    )
+    eq_(response.status_code, status_code)
+    return loads(response.data) if status_code == 200 else None
+
+  def test_batch_post(self):
+    rv = self.send('POST', '/api/cats/', [
+      {'id': 30, 'name': 'tom'},
+      'not a cat',
+      {'id': 31, 'name': 'felix'},
+      {'id': 32, 'color': 'black'},
+    ])
+    eq_(
+      [status['status'] for status in rv['data']],
+      ['created', 'invalid', 'created', 'invalid']
+    )
+    eq_(rv['data'][2]['key'], {'id': 31})
+    eq_(rv['meta']['statuses'], {'created': 2, 'invalid': 2})
+    eq_(self.Cat.q.get(31).name, 'felix')
+    self.send('POST', '/api/cats/', [{'id': 0}], 400)
+
+  def test_batch_patch(self):
+    rv = self.send('PATCH', '/api/cats/', [
+      {'id': '1', 'age': 10},
+      {'id': 2, 'name': 'garfield'},
+      {'id': 40, 'age': 10},
+      {'age': 10},
+      {'id': 3, 'color': 'black'},
+      {'id': 4},
+    ])
+    eq_(
+      [status['status'] for status in rv['data']],
+      ['updated', 'updated', 'not found', 'invalid', 'invalid', 'invalid']
+    )
+    eq_(rv['data'][0]['key'], {'id': 1})
+    eq_(self.Cat.q.get(1).age, 10)
+    eq_(self.Cat.q.get(2).name, 'garfield')
+
+  def test_batch_delete(self):
+    rv = self.send('DELETE', '/api/cats/', ['1', 2, 40])
+    eq_(rv['meta']['statuses'], {'deleted': 2, 'not found': 1})
+    eq_(rv['data'][0], {'key': {'id': 1}, 'status': 'deleted'})
+    self.send('DELETE', '/api/cats/', ['a'], 400)
+    eq_(self.Cat.q.count(), 23)
+    rv = self.send('DELETE', '/api/cats/?filter=age;eq;0', None)
+    eq_(rv['meta']['statuses'], {'deleted': 7})
+    eq_(self.Cat.q.count(), 16)
+    self.send('DELETE', '/api/cats/', None, 400)
+
+  def test_convert_key(self):
+    columns = [Column('name', String(16)), Column('id', Integer)]
+    eq_(_convert_key(columns, (u'ren\xe9', '2')), (u'ren\xe9', 2))
+    assert_raises(ValueError, _convert_key, columns, (u'a', u'b'))
+
+  def test_batch_not_allowed(self):
+    self.send('DELETE', '/api/other_cats/?filter=id;gt;-1', None, 405)
+    self.send('DELETE', '/api/other_cats/', [1, 2], 405)
+    self.send('PATCH', '/api/other_cats/', [{'id': 1, 'age': 10}], 405)
+    self.send('POST', '/api/other_cats/', [{'id': 30}], 405)
+    eq_(self.Cat.q.count(), 25)
+    eq_(self.Cat.q.get(1).age, 1)
+    self.send('POST', '/api/other_cats/', {'id': 30})
+    self.send('DELETE', '/api/other_cats/1', None)
+    eq_(self.Cat.q.count(), 25)
+
+  def test_conditional_get(self):
+    for url in ['/api/cats/?filter=age;eq;1', '/api/cats/3']:
+      response = self.client.get(url)
+      eq_(response.status_code, 200)
+      etag = response.headers['ETag']
+      rv = self.client.get(url, headers={'If-None-Match': etag})
+      eq_(rv.status_code, 304)
+      eq_(rv.data, '')
+      rv = self.client.get(url, headers={
+        'If-Modified-Since': response.headers['Last-Modified']
+      })
+      eq_(rv.status_code, 304)
+    eq_(
+      self.client.get('/api/cats/?filter=age;eq;2', headers={
+        'If-None-Match': etag
+      }).status_code,
+      200
+    )
+    headers = {'If-None-Match': '*'}
+    eq_(self.client.get('/api/cats/30', headers=headers).status_code, 404)
+    start_profile()
+    try:
+      status_code = self.client.get('/api/cats/3', headers=headers).status_code
+    finally:
+      profile = stop_profile()
+    eq_(status_code, 304)
+    eq_(profile['statements'], 1) # validators from the loaded model
+    self.Cat.q.get(3).updated = datetime(2014, 2, 1)
+    self.Cat.q.session.commit()
+    eq_(
+      self.client.get('/api/cats/3', headers={'If-None-Match': etag})
+        .status_code,
+      200
+    )
+
+
+class Test_Cache(_Fixture):
+
+  parser_options = {'default_limit': 10, 'cache_size': 10000}
+
+  def test_cached_response(self):
+    url = '/api/cats/?filter=age;eq;1&sort=id;desc'
+    rv = self.get(url)
+    eq_(rv['meta']['cache'], {'hit': False, 'hits': 0, 'misses': 1})
+    cached = self.get(url)
+    eq_(cached['meta']['cache'], {'hit': True, 'hits': 1, 'misses': 1})
+    eq_(cached['data'], rv['data'])
+    eq_(cached['meta']['matches'], rv['meta']['matches'])
+    eq_(self.get('/api/cats/1')['meta']['cache']['hit'], False)
+    eq_(self.get('/api/cats/1')['meta']['cache']['hit'], True)
+    self.Cat.q.get(1).name = u'garfield'
+    self.Cat.q.session.commit()
+    rv = self.get(url)
+    eq_(rv['meta']['cache']['hit'], False)
+    eq_(rv['data'][-1]['name'], 'garfield')
+    eq_(self.get('/api/cats/1')['data']['name'], 'garfield')
+
+  def test_read_before_commit(self):
+    url = '/api/cats/1'
+    self.get(url)
+    self.Cat.q.get(1).name = u'garfield'
+    self.Cat.q.session.flush()
+    eq_(self.get(url)['meta']['cache']['hit'], False)
+    eq_(self.get(url)['meta']['cache']['hit'], True)
+    self.Cat.q.session.commit()
+    eq_(self.get(url)['meta']['cache']['hit'], False)
+    self.Cat.q.get(1).name = u'felix'
+    self.Cat.q.session.flush()
+    self.Cat.q.session.rollback()
+    eq_(self.get(url)['data']['name'], 'garfield')
+    self.Cat.q.session.commit()
+    eq_(self.get(url)['meta']['cache']['hit'], True)
+
+  def test_dependencies(self):
+
+    class Owner(object):
+
+      __tablename__ = 'owners'
+
+    def get():
+      response = self.parser.jsonify_cached(
+        self.Cat, lambda: self.Cat.q.get(1), dependencies=[Owner]
+      )
+      return loads(response.data)['meta']['cache']['hit']
+
+    with self.app.test_request_context('/api/cats/1'):
+      eq_(get(), False)
+      eq_(get(), True)
+      models_written.send(Owner)
+      eq_(get(), False)
+
+  def test_cached_cursors(self):
+    url = '/api/cats/?cursor='
+    rv = self.get(url)
+    cached = self.get(url)
+    eq_(cached['meta']['cache']['hit'], True)
+    eq_(cached['meta']['cursors'], rv['meta']['cursors'])
+
+
+class Test_Replicas(object):
+
+  def setup(self):
+    # rows tell which database each request read from
+    engines = [create_engine('sqlite://') for _ in range(2)]
+    session = scoped_session(sessionmaker(
+      bind=engines[0], class_=RoutingSession, router=ReplicaRouter(engines[1:])
+    ))
+    orm = ORM(session)
+
+    class Cat(orm.Model):
+
+      id = Column(Integer, primary_key=True)
+      name = Column(Unicode(32))
+
+    for engine, name in zip(engines, [u'primary', u'replica']):
+      orm.Model.metadata.create_all(engine)
+      engine.execute(Cat.__table__.insert(), id=1, name=name)
+
+    app = Flask('kit')
+    api = API(app)
+
+    class CatView(api.View):
+
+      __model__ = Cat
+
+    api.register(app)
+    self.session = session
+    self.client = app.test_client()
+
+  def teardown(self):
+    self.session.remove()
+
+  def test_reads(self):
+    rv = loads(self.client.get('/api/cats/').data)
+    eq_([cat['name'] for cat in rv['data']], ['replica'])
+    rv = loads(self.client.get('/api/cats/1').data)
+    eq_(rv['data']['name'], 'replica')
+
+
+class Test_ShardedParser(_ShardedFixture, Test_Parser):
+
+  def test_count_cache(self):
+    with self.Cat.q.session.using_shard(1): # for the untracked delete
+      super(Test_ShardedParser, self).test_count_cache()
+
+  def test_count_before_commit(self):
+    with self.Cat.q.session.using_shard(1):
+      super(Test_ShardedParser, self).test_count_before_commit()
+
+  def test_estimated_count(self):
+    self.parser.options['count'] = 'estimate'
+    self.Cat.q.session.execute('ANALYZE')
+    eq_( # estimates aren't merged across shards
+      self.get('/api/cats/')['meta']['matches'],
+      {'total': 25, 'exact': True, 'returned': 10}
+    )
+
+  def test_profile(self):
+    start_profile()
+    try:
+      profile = self.get('/api/cats/?filter=age;eq;1')['meta']['profile']
+    finally:
+      stop_profile()
+    eq_(profile['statements'], 6) # on each shard, from the pool's threads
+
+
+class Test_ShardedView(_ShardedFixture, Test_View):
+
+  pass
+
@@ -2,20 +2,28 @@
 
 from celery import Celery
 from flask import Flask
+from flask import Flask as BaseFlask
+from functools import partial
+from json import loads
 from itertools import repeat
 from nose import run
-from nose.tools import ok_, eq_, nottest, raises, timed
-from os import chdir, close, pardir, unlink
+from nose.tools import assert_raises, ok_, eq_, nottest, raises, timed
+from os import chdir, close, getpid, pardir, unlink
+from StringIO import StringIO
 from os.path import abspath, dirname, exists, join
 from requests import ConnectionError, get
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DisconnectionError, IntegrityError
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm.scoping import scoped_session
 from subprocess import Popen, PIPE
+import sys
 from tempfile import mkstemp
 from threading import Thread
 from time import sleep, time
 
 from kit import Celery, Flask, get_session, get_kit, teardown_handler
+from kit import __main__ as main, base
 from kit.base import Kit, KitError
 
 
@@ -56,6 +64,9 @@ class Test_FirstExample(object):
   def test_view(self):
     eq_(self.client.get('/').status_code, 200)
 
+  def test_metrics_disabled(self):
+    eq_(self.client.get('/metrics').status_code, 404)
+
   def test_get_session(self):
     sessions = self.kit.sessions.values()
     eq_(len(sessions), 1)
@@ -76,6 +87,13 @@ class Test_FirstExample(object):
     first = get_views(self.client.get('/').data)
     second = get_views(self.client.get('/').data)
     eq_(first + 1, second)
+    samples = dict(
+      (name, samples) for name, _, samples in self.kit.metrics.collect()
+    )
+    eq_(
+      [labels for labels, _ in samples['kit_session_commit_seconds']],
+      [{'session': 'db'}]
+    )
 
   def test_session_query(self):
     from app import Visit
@@ -106,6 +124,171 @@ class Test_FirstExample(object):
 
     del self.kit._teardown_handler
 
+class Test_Fork(object):
+
+  def setup(self):
+    handle, self.db_path = mkstemp(suffix='.db')
+    close(handle)
+    handle, self.conf_path = mkstemp(suffix='.yaml')
+    close(handle)
+    with open(self.conf_path, 'w') as writer:
+      writer.write(
+        'sessions:\n'
+        '  fork_db:\n'
+        '    url: sqlite:///%s\n'
+        '    options:\n'
+        '      warmup: 2\n' % (self.db_path, )
+      )
+    self.kit = get_kit(self.conf_path)
+    self.pid = getpid()
+
+  def teardown(self):
+    base.getpid = getpid
+    Kit._Kit__state = {}
+    Kit._sessions.pop('fork_db', None)
+    Kit._engines.pop('fork_db', None)
+    unlink(self.conf_path)
+    unlink(self.db_path)
+
+  def fork(self):
+    """Simulate running in a forked child process."""
+    base.getpid = lambda: self.pid + 1
+
+  def test_check_fork(self):
+    session = get_session('fork_db')
+    inherited_session = session()
+    engine, _ = self.kit._engines['fork_db'][0]
+    pool = engine.pool
+    connects = []
+    event.listen(engine, 'connect', lambda *args: connects.append(args))
+    self.kit.check_fork()
+    ok_(engine.pool is pool) # same process
+    self.fork()
+    self.kit.check_fork()
+    ok_(engine.pool is not pool)
+    ok_(pool in base._inherited_pools)
+    eq_(len(connects), 2) # warmup
+    ok_(session() is not inherited_session)
+
+  def test_inherited_connection(self):
+    engine = create_engine('sqlite:///%s' % (self.db_path, ),
+                           poolclass=QueuePool)
+    event.listen(engine, 'connect', base._on_connect)
+    event.listen(engine, 'checkout', base._on_checkout)
+    connection = engine.connect()
+    inherited = connection.connection.connection
+    connection.close()
+    self.fork()
+    connection = engine.connect()
+    ok_(connection.connection.connection is not inherited)
+    ok_(inherited in base._inherited_connections)
+    eq_(inherited.execute('SELECT 1').fetchone(), (1, )) # still open
+    record = connection.connection._connection_record
+    record.info['pid'] = self.pid
+    assert_raises(
+      DisconnectionError,
+      base._on_checkout, record.connection, record, connection.connection
+    )
+    connection.close()
+
+  def test_warm_up(self):
+    engine = create_engine('sqlite:///%s' % (self.db_path, ),
+                           poolclass=QueuePool, pool_size=5)
+    base._warm_up(engine, 3)
+    eq_(engine.pool.checkedin(), 3)
+    eq_(engine.pool.checkedout(), 0)
+
+
+class Test_Metrics(object):
+
+  def get_client(self, token=None):
+    app = BaseFlask('metrics')
+    app.add_url_rule(
+      '/metrics', 'kit_metrics', partial(base._metrics_view, token=token)
+    )
+    return app.test_client()
+
+  def test_local_only(self):
+    client = self.get_client()
+    response = client.get('/metrics')
+    eq_(response.status_code, 200)
+    eq_(response.mimetype, 'text/plain')
+    response = client.get(
+      '/metrics', environ_base={'REMOTE_ADDR': '10.0.0.1'}
+    )
+    eq_(response.status_code, 404)
+
+  def test_token(self):
+    client = self.get_client(token='secret')
+    eq_(client.get('/metrics').status_code, 404)
+    for authorization in ['Bearer other', 'secret', u'Bearer s\xe9cret']:
+      response = client.get(
+        '/metrics', headers={'Authorization': authorization}
+      )
+      eq_(response.status_code, 404)
+    response = client.get(
+      '/metrics',
+      headers={'Authorization': 'Bearer secret'},
+      environ_base={'REMOTE_ADDR': '10.0.0.1'},
+    )
+    eq_(response.status_code, 200)
+
+  def test_kit_stats(self):
+    Kit.metrics.increment('test_stats_total', queue='a')
+    try:
+      stats = base.kit_stats(None)
+      eq_(
+        stats['test_stats_total'],
+        [{'labels': {'queue': 'a'}, 'value': 1}]
+      )
+      ok_(all(
+        set(sample) == set(['labels', 'value'])
+        for samples in stats.values()
+        for sample in samples
+      ))
+    finally:
+      Kit.metrics.clear()
+
+  def test_run_stats(self):
+    requests = []
+
+    class Response(object):
+      def read(self):
+        return 'requests_total 1'
+
+    class Control(object):
+      def broadcast(self, command, reply, timeout):
+        eq_(command, 'kit_stats')
+        return [{'w1': {'jobs_total': [{'labels': {}, 'value': 2}]}}]
+
+    class App(object):
+      control = Control()
+
+    class FakeKit(object):
+      config = {'flasks': [{'metrics': '/metrics', 'metrics_token': 't'}]}
+      celeries = [App()]
+
+    def urlopen(req):
+      requests.append(req)
+      return Response()
+
+    original_urlopen = main.urlopen
+    main.urlopen = urlopen
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+      main.run_stats(FakeKit(), 5001)
+      output = sys.stdout.getvalue()
+    finally:
+      main.urlopen = original_urlopen
+      sys.stdout = stdout
+    eq_(requests[0].get_full_url(), 'http://127.0.0.1:5001/metrics')
+    eq_(requests[0].get_header('Authorization'), 'Bearer t')
+    lines = output.split('\n', 2)
+    eq_(lines[:2], ['requests_total 1', '# w1'])
+    eq_(loads(lines[2]), {'jobs_total': [{'labels': {}, 'value': 2}]})
+
+
 if __name__ == '__main__':
   run()
     
@@ -1,3 +1,829 @@
 #!/usr/bin/env python
 
-from nose.tools import ok_, eq_
+from celery import Celery
+from celery.task import periodic_task
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from json import loads
+from nose import SkipTest
+from nose.tools import assert_raises, ok_, eq_, raises
+from numpy import load
+from os import listdir
+from os.path import join
+from shutil import rmtree
+from sqlalchemy import (Column, create_engine, Date, DateTime, event,
+  ForeignKey, func, Integer, Numeric, Unicode)
+from sqlalchemy.sql.expression import Insert
+from sqlalchemy.orm import scoped_session, sessionmaker
+from tempfile import mkdtemp
+from threading import Condition, Thread
+from time import time
+
+from kit.ext import ORM
+from kit.ext.orm import models_written
+from kit.util import (get_profile, JSONEncodedDict, Profiler, ReplicaRouter,
+  RoutingSession, ShardedSession, start_profile, stop_profile)
+
+
+class Test_Model(object):
+
+  def setup(self):
+    self.session = scoped_session(
+      sessionmaker(bind=create_engine('sqlite://'))
+    )
+    orm = ORM(self.session)
+
+    class House(orm.Model):
+
+      id = Column(Integer, primary_key=True)
+      address = Column(Unicode(64))
+      built = Column(Date)
+      price = Column(Numeric(10, 2, asdecimal=True))
+      extra = Column(JSONEncodedDict)
+
+      @property
+      def description(self):
+        return 'house at %s' % (self.address, )
+
+    class Cat(orm.Model):
+
+      id = Column(Integer, primary_key=True)
+      name = Column(Unicode(64))
+      born = Column(DateTime)
+      house_id = Column(ForeignKey('houses.id'))
+
+      house = orm.relationship('House', lazy='joined')
+
+    orm.create_all()
+    self.House = House
+    self.Cat = Cat
+
+  def teardown(self):
+    self.session.remove()
+
+  def test_to_json(self):
+    house = self.House(
+      id=1,
+      address=u'here',
+      built=date(2013, 5, 1),
+      price=Decimal('10.5'),
+      extra={'a': [1]},
+    )
+    cat = self.Cat(id=2, name=u'Tom', born=datetime(2013, 5, 2), house=house)
+    self.session.add(cat)
+    self.session.commit()
+    eq_(
+      cat.to_json(depth=3),
+      {
+        'id': 2,
+        'name': 'Tom',
+        'born': '2013-05-02 00:00:00',
+        'house_id': 1,
+        'house': {
+          'id': 1,
+          'address': 'here',
+          'built': '2013-05-01',
+          'price': 10.5,
+          'extra': {'a': [1]},
+          'description': 'house at here',
+        },
+      }
+    )
+    eq_(cat.to_json(depth=1)['house'], {'id': 1})
+    self.session.expire(cat)
+    eq_(cat.to_json()['name'], 'Tom')
+
+  def test_to_json_override(self):
+    cat = self.Cat(id=1, name=u'Tom')
+    eq_(set(cat.to_json()), set(['id', 'name', 'born', 'house_id', 'house']))
+    self.Cat.__json__ = ['name']
+    eq_(cat.to_json(), {'name': 'Tom'})
+    cat.__json__ = ['id']
+    eq_(cat.to_json(), {'id': 1})
+
+
+class Test_Query(object):
+
+  def setup(self):
+    self.session = scoped_session(
+      sessionmaker(bind=create_engine('sqlite://'))
+    )
+    orm = ORM(self.session)
+
+    class Cat(orm.Model):
+
+      id = Column(Integer, primary_key=True)
+      age = Column(Integer)
+
+    class Dog(orm.Model):
+
+      name = Column(Unicode(16), primary_key=True)
+
+    orm.create_all()
+    self.session.add_all(Cat(id=3 * i, age=i % 5) for i in range(200))
+    self.session.add_all(Dog(name=u'dog%s' % index) for index in range(20))
+    self.session.commit()
+    self.Cat = Cat
+    self.Dog = Dog
+
+  def teardown(self):
+    self.session.remove()
+
+  def test_random(self):
+    cats = self.Cat.q.random(50)
+    eq_(len(set(cat.id for cat in cats)), 50)
+    ok_(isinstance(self.Cat.q.random(), self.Cat))
+    cats = self.Cat.q.filter(self.Cat.age == 2).random(30)
+    eq_(len(set(cat.id for cat in cats)), 30)
+    ok_(all(cat.age == 2 for cat in cats))
+    eq_(len(self.Cat.q.filter(self.Cat.age == 2).random(100)), 40)
+    eq_(self.Cat.q.filter(self.Cat.age > 10).random(5), [])
+
+  def test_random_sparse_keys(self):
+    query = self.Cat.q.filter(self.Cat.age == 2)
+    query._sample_reservoir = None # the database sorts the remaining keys
+    cats = query._sample_key_range(self.Cat, 35, max_attempts=1)
+    eq_(len(set(cat.id for cat in cats)), 35)
+    ok_(all(cat.age == 2 for cat in cats))
+    eq_(len(query._sample_sorted(self.Cat, 50)), 40)
+
+  def test_random_reservoir(self):
+    dogs = self.Dog.q.random(5)
+    eq_(len(set(dog.name for dog in dogs)), 5)
+    eq_(len(self.Dog.q.random(30)), 20)
+
+  def test_retrieve_many(self):
+    rows = [
+      {'id': 3, 'age': 10},     # existing
+      {'id': 4, 'age': 11},     # new
+      {'id': 4, 'age': 12},     # duplicate
+      {'id': 5},                # new, with different arguments
+    ]
+    results = self.Cat.retrieve_many(rows, chunk_size=2)
+    eq_(
+      [(cat.id, cat.age, flag) for cat, flag in results],
+      [(3, 1, False), (4, 11, True), (4, 11, False), (5, None, True)]
+    )
+    eq_(self.Cat.q.fast_count(), 202)
+    eq_(
+      self.Cat.retrieve_many(rows[-1:], load_instances=False),
+      [((5, ), False)]
+    )
+    results = self.Cat.retrieve_many([{'id': '6'}, {'id': 6}, {'id': '9'}])
+    eq_(
+      [(cat.id, flag) for cat, flag in results],
+      [(6, False), (6, False), (9, False)]
+    )
+    eq_(
+      self.Cat.retrieve_many([{'id': '7'}], load_instances=False),
+      [((7, ), True)]
+    )
+    assert_raises(ValueError, self.Cat.retrieve_many, [{'id': 'a'}])
+
+  def test_bulk_create(self):
+    eq_(self.Cat.bulk_create([{'age': 1}, {'id': 1000, 'age': 2}]), 2)
+    eq_(self.Cat.q.fast_count(), 202)
+    keys = self.Cat.bulk_create([{'age': 3}, {'id': 2000}], return_keys=True)
+    eq_(keys, [(1001, ), (2000, )])
+    assert_raises(ValueError, self.Cat.bulk_create, [{'color': 'black'}])
+    self.session.rollback()
+    eq_(self.Cat.q.fast_count(), 200)
+
+  def test_records_row_types(self):
+    query = self.Cat.q.filter(self.Cat.id < 9).order_by(self.Cat.id)
+    eq_(list(query.to_records()), [
+      {'id': 0, 'age': 0}, {'id': 3, 'age': 1}, {'id': 6, 'age': 2},
+    ])
+    eq_(list(query.to_records(row_type='tuple', batch_size=2)),
+        [(0, 0), (3, 1), (6, 2)])
+    records = query.to_records(row_type='namedtuple', stream_results=True)
+    eq_([record.age for record in records], [0, 1, 2])
+    eq_(
+      list(query.to_records(row_type='columns', batch_size=2)),
+      [{'id': [0, 3], 'age': [0, 1]}, {'id': [6], 'age': [2]}]
+    )
+
+  def test_chunked_dataframe(self):
+    self.Cat.q.get(3).age = None
+    self.session.commit()
+    query = self.Cat.q.order_by(self.Cat.id)
+    expected = query.to_dataframe()
+    df = query.to_dataframe(chunk_size=7)
+    eq_(str(df['id'].dtype), 'int64')
+    eq_(str(df['age'].dtype), 'Int64')
+    eq_(df['age'].isnull().sum(), 1)
+    eq_(list(df['id']), list(expected['id']))
+    eq_(list(df['age'].fillna(-1)), list(expected['age'].fillna(-1)))
+    chunks = list(query.to_dataframe(iterator=True, chunk_size=64))
+    eq_([len(chunk) for chunk in chunks], [64, 64, 64, 8])
+    eq_([str(chunk['age'].dtype) for chunk in chunks], ['Int64'] * 4)
+    df = query.to_dataframe(chunk_size=50, exclude=['age'], index='id')
+    eq_(list(df.columns), [])
+    eq_(list(df.index[:3]), [0, 3, 6])
+    df = query.to_dataframe(chunk_size=50, exclude=['id'], index='id')
+    eq_(list(df.columns), ['age'])
+    eq_(list(df.index[:3]), [0, 3, 6])
+
+  def test_chunked_dataframe_growth(self):
+    self.Cat.q.get(3).age = None
+    self.session.commit()
+    query = self.Cat.q.order_by(self.Cat.id)
+    query.count = lambda: 5 # as if rows were inserted after the count
+    df = query.to_dataframe(chunk_size=7)
+    eq_(len(df), 200)
+    eq_(list(df['age'].isnull()[:3]), [False, True, False])
+    eq_(df['age'].isnull().sum(), 1)
+
+  def test_export(self):
+    path = mkdtemp()
+    try:
+      query = self.Cat.q.filter(self.Cat.age == 2)
+      eq_(query.export(join(path, 'cats.csv'), chunk_size=7), 40)
+      eq_(query.export(join(path, 'part.csv'), until=66), 5)
+      eq_(query.export(join(path, 'part.csv'), after=66, append=True), 35)
+      with open(join(path, 'cats.csv')) as reader:
+        lines = reader.readlines()
+      eq_(lines[:2], ['id,age\r\n', '6,2\r\n'])
+      with open(join(path, 'part.csv')) as reader:
+        eq_(reader.readlines(), lines)
+      query.export(join(path, 'cats.jsonl'), format='jsonl', after=585)
+      with open(join(path, 'cats.jsonl')) as reader:
+        eq_(map(loads, reader), [{'id': 591, 'age': 2}])
+      eq_(query.export(join(path, 'npy'), format='npy', chunk_size=16), 40)
+      eq_(list(load(join(path, 'npy', 'id.npy'))[:3]), [6, 21, 36])
+      eq_(load(join(path, 'npy', 'age.npy')).sum(), 80)
+      query = self.Cat.q.filter(self.Cat.age > 10)
+      eq_(query.export(join(path, 'empty'), format='npy'), 0)
+      eq_(len(load(join(path, 'empty', 'id.npy'))), 0)
+    finally:
+      rmtree(path)
+
+  def test_arrow_export(self):
+    try:
+      import pyarrow
+      from pyarrow.parquet import read_table
+    except ImportError:
+      raise SkipTest
+    path = mkdtemp()
+    try:
+      query = self.Cat.q.filter(self.Cat.age == 2)
+      eq_(query.export(join(path, 'cats.parquet'), 'parquet', chunk_size=7), 40)
+      table = read_table(join(path, 'cats.parquet'))
+      eq_(table.num_rows, 40)
+      eq_(table.column('id').to_pylist()[:3], [6, 21, 36])
+      eq_(query.export(join(path, 'cats.feather'), 'feather', chunk_size=7), 40)
+      with open(join(path, 'cats.feather'), 'rb') as reader:
+        table = pyarrow.ipc.open_file(reader).read_all()
+      eq_(table.to_pydict()['age'], [2] * 40)
+      assert_raises(
+        ValueError, query.export, join(path, 'more.parquet'), 'parquet',
+        append=True
+      )
+    finally:
+      rmtree(path)
+
+  def test_snapshot(self):
+    path = mkdtemp()
+    try:
+      query = self.Cat.q.filter(self.Cat.age == 2)
+      arrays = query.snapshot('cats', directory=path)
+      eq_(arrays.keys(), ['id', 'age'])
+      eq_(len(arrays['id']), 40)
+      self.Cat.q.get(3).age = 2
+      self.session.commit()
+      ok_(query.snapshot('cats', directory=path) is arrays) # not expired
+      df = query.snapshot('cats', directory=path, refresh=True,
+                          as_dataframe=True)
+      eq_(list(df['id'][:3]), [3, 6, 21])
+      query.snapshot('cats', ttl=1e-6, directory=path)
+      eq_(len(listdir(path)), 4) # lock, link, current and previous versions
+    finally:
+      rmtree(path)
+
+  def test_bulk_update(self):
+    cat = self.Cat.q.get(3)
+    eq_(cat.age, 1)
+    rows = [{'id': 0, 'age': 10}, {'id': 3, 'age': 11}, {'id': 1, 'age': 12}]
+    eq_(self.Cat.bulk_update(rows + [{'id': 6}]), 2)
+    eq_(cat.age, 11)
+    eq_(self.Cat.q.get(0).age, 10)
+
+
+class Test_Profiler(object):
+
+  def setup(self):
+    engine = create_engine('sqlite://')
+    self.session = scoped_session(sessionmaker(bind=engine))
+    orm = ORM(self.session)
+    Profiler(engine, n_plus_one=3)
+
+    class House(orm.Model):
+
+      id = Column(Integer, primary_key=True)
+
+    class Cat(orm.Model):
+
+      id = Column(Integer, primary_key=True)
+      house_id = Column(ForeignKey('houses.id'))
+
+      house = orm.relationship('House')
+
+      @property
+      def roommates(self):
+        return Cat.q.filter(Cat.house_id == self.house_id).count()
+
+    orm.create_all()
+    self.session.add_all(Cat(id=i, house=House(id=i)) for i in range(5))
+    self.session.commit()
+    self.session.remove()
+    self.Cat = Cat
+
+  def teardown(self):
+    stop_profile()
+    self.session.remove()
+
+  def test_n_plus_one(self):
+    start_profile()
+    cats = self.Cat.q.all()
+    eq_(get_profile()['statements'], 1)
+    houses = [cat.house for cat in cats]
+    profile = stop_profile()
+    eq_(profile['statements'], 6)
+    eq_(profile['repeated'][0]['count'], 5)
+    eq_(len(profile['n_plus_one']), 1)
+    eq_(profile['n_plus_one'][0]['attribute'], 'Cat.house')
+    ok_('test_orm.py' in profile['n_plus_one'][0]['location'])
+    start_profile()
+    eq_(sum(cat.roommates for cat in cats), 5)
+    eq_(get_profile()['n_plus_one'][0]['attribute'], 'Cat.roommates')
+    stop_profile()
+    eq_(get_profile(), None)
+
+
+class Test_Partitions(object):
+
+  def setup(self):
+    # connections of in-memory databases don't share tables
+    self.path = mkdtemp()
+    self.session = scoped_session(sessionmaker(
+      bind=create_engine('sqlite:///%s' % (join(self.path, 'test.db'), ))
+    ))
+    orm = ORM(self.session)
+
+    class Cat(orm.Model):
+
+      id = Column(Integer, primary_key=True)
+      age = Column(Integer)
+
+    class Owner(orm.Model):
+
+      name = Column(Unicode(32), primary_key=True)
+
+    orm.create_all()
+    self.session.add_all(Cat(id=3 * i, age=i % 5) for i in range(200))
+    self.session.add(Owner(name=u'tom'))
+    self.session.commit()
+    self.Cat = Cat
+    self.Owner = Owner
+
+  def teardown(self):
+    self.session.remove()
+    rmtree(self.path)
+
+  def test_parallel_dataframe(self):
+    query = self.Cat.q.filter(self.Cat.age > 0).order_by(self.Cat.id)
+    expected = query.to_dataframe()
+    for processes in [False, True]:
+      df = query.to_dataframe(workers=3, partitions=7, processes=processes)
+      eq_(df.to_dict('list'), expected.to_dict('list'))
+    df = query.to_dataframe(
+      workers=2,
+      partitions=[self.Cat.age == 2, self.Cat.age == 1, self.Cat.id < 0],
+      chunk_size=10,
+    )
+    eq_(list(df['age']), [2] * 40 + [1] * 40)
+    eq_(len(self.Cat.q.filter(self.Cat.id < 0).to_dataframe(workers=2)), 0)
+
+  def test_non_integer_key(self):
+    assert_raises(ValueError, self.Owner.q.to_dataframe, workers=2)
+    df = self.Owner.q.to_dataframe(workers=2, partitions=[self.Owner.name > u''])
+    eq_(list(df['name']), [u'tom'])
+
+
+class Test_Replicas(object):
+
+  def setup(self):
+    # each in-memory database is distinct, rows tell where queries ran
+    self.engines = [create_engine('sqlite://') for _ in range(3)]
+    self.router = ReplicaRouter(self.engines[1:])
+    self.session = scoped_session(sessionmaker(
+      bind=self.engines[0], class_=RoutingSession, router=self.router
+    ))
+    orm = ORM(self.session)
+
+    class Cat(orm.Model):
+
+      id = Column(Integer, primary_key=True)
+
+    for index, engine in enumerate(self.engines):
+      orm.Model.metadata.create_all(engine)
+      engine.execute(Cat.__table__.insert(), id=index)
+    self.Cat = Cat
+
+  def teardown(self):
+    self.session.remove()
+
+  def get_ids(self, query=None):
+    return [cat.id for cat in (query or self.Cat.q)]
+
+  def test_round_robin(self):
+    eq_([self.get_ids() for _ in range(3)], [[1], [2], [1]])
+    eq_(self.get_ids(self.Cat.q.on_primary()), [0])
+    eq_(list(self.Cat.q.to_records(row_type='tuple')), [(2, )])
+
+  def test_writes(self):
+    self.session.add(self.Cat(id=10))
+    eq_(self.get_ids(), [0, 10]) # autoflushed
+    self.session.commit()
+    eq_(self.get_ids(), [1])
+    self.Cat.q.filter(self.Cat.id == 0).delete()
+    eq_(self.get_ids(), [10])
+    self.session.rollback()
+    eq_(self.get_ids(self.Cat.q.with_lockmode('update')), [0, 10])
+
+  def test_bulk_writes(self):
+    eq_(
+      [(cat.id, flag) for cat, flag in self.Cat.retrieve_many([{'id': 5}])],
+      [(5, True)]
+    )
+    self.session.rollback()
+    eq_(self.get_ids(), [1])
+    eq_(self.Cat.bulk_create([{'id': 7}]), 1)
+    eq_(self.get_ids(), [0, 7])
+    self.session.commit()
+    eq_(self.get_ids(), [2])
+
+  def test_health(self):
+    self.router.engines[0] = create_engine('sqlite:////no/such/dir/cats.db')
+    self.router.strategy = 'least_connections'
+    eq_([self.get_ids() for _ in range(2)], [[2], [2]])
+    self.router.engines = self.router.engines[:1]
+    eq_(self.get_ids(), [0])
+
+
+class Test_Shards(object):
+
+  def setup(self):
+    # fan-out queries use connections from the pool's threads
+    self.engines = [
+      create_engine('sqlite://', connect_args={'check_same_thread': False})
+      for _ in range(3)
+    ]
+    self.session = scoped_session(sessionmaker(
+      class_=ShardedSession, shards=dict(enumerate(self.engines))
+    ))
+    orm = ORM(self.session)
+
+    class Owner(orm.Model):
+
+      id = Column(Integer, primary_key=True)
+
+    class Cat(orm.Model):
+
+      __shard_key__ = 'owner_id'
+
+      id = Column(Integer, primary_key=True)
+      owner_id = Column(Integer)
+      age = Column(Integer)
+
+    for engine in self.engines:
+      orm.Model.metadata.create_all(engine)
+    self.session.add(Owner(id=1))
+    self.session.add_all(
+      Cat(id=index, owner_id=index % 5, age=index % 7) for index in range(30)
+    )
+    self.session.commit()
+    self.Cat = Cat
+    self.Owner = Owner
+
+  def teardown(self):
+    self.session.remove()
+
+  def get_counts(self, table):
+    return [
+      engine.execute('SELECT COUNT(*) FROM %s' % (table, )).scalar()
+      for engine in self.engines
+    ]
+
+  def test_writes(self):
+    eq_(self.get_counts('cats'), [12, 12, 6]) # owners 0 and 3, 1 and 4, 2
+    eq_(self.get_counts('owners'), [1, 0, 0])
+    cat = self.Cat.q.filter(self.Cat.owner_id == 2).first()
+    cat.age = 10
+    self.session.commit()
+    eq_(self.engines[2].execute('SELECT MAX(age) FROM cats').scalar(), 10)
+    rows = [{'id': 30, 'owner_id': 2}, {'id': 31, 'owner_id': 0}]
+    eq_(self.Cat.bulk_create(rows, return_keys=True), [(30, ), (31, )])
+    eq_(self.get_counts('cats'), [13, 12, 7])
+    raises(ValueError)(self.Cat.bulk_create)([{'id': 32}])
+    rows = [
+      {'id': 33, 'owner_id': 1}, {'id': 2, 'owner_id': 2},
+      {'id': 34, 'owner_id': 0}, {'id': 33, 'owner_id': 1},
+    ]
+    eq_(
+      [(cat.id, flag) for cat, flag in self.Cat.retrieve_many(rows)],
+      [(33, True), (2, False), (34, True), (33, False)]
+    )
+    eq_(self.get_counts('cats'), [14, 13, 7])
+    eq_(self.Cat.q.filter(self.Cat.age == 0).delete(), 5)
+    eq_(self.get_counts('cats'), [12, 11, 6])
+    cat.owner_id = 3
+    raises(ValueError)(self.session.flush)()
+
+  def test_single_shard(self):
+    query = self.Cat.q.filter(self.Cat.owner_id == 4, self.Cat.age < 5)
+    eq_(query._get_shard_ids(), [1])
+    eq_(sorted(cat.id for cat in query), [4, 9, 14, 24, 29])
+    query = self.Cat.q.filter(self.Cat.owner_id.in_([3, 0]))
+    eq_(query._get_shard_ids(), [0])
+    eq_(len(list(query.to_records())), 12)
+    query = self.Cat.q.filter_by(owner_id=2).order_by(self.Cat.id.desc())
+    eq_(query.first().id, 27)
+    eq_(self.Owner.q.get(1).id, 1)
+
+  def test_fan_out(self):
+    eq_(self.Cat.q.get(8).owner_id, 3)
+    query = self.Cat.q.order_by(self.Cat.age.desc(), self.Cat.id)
+    expected = sorted(range(30), key=lambda index: (-(index % 7), index))
+    eq_([cat.id for cat in query], expected)
+    eq_([cat.id for cat in query.offset(3).limit(4)], expected[3:7])
+    eq_(self.Cat.q.fast_count(), 30)
+    eq_(self.Cat.q.filter(self.Cat.age > 4).count(), 8)
+    eq_(
+      self.session.query(func.max(self.Cat.age), func.sum(self.Cat.id)).one(),
+      (6, 435)
+    )
+    query = self.Cat.q.order_by(func.abs(self.Cat.age))
+    raises(ValueError)(query.all)()
+
+  def test_unmergeable_fan_out(self):
+    Cat = self.Cat
+    queries = [
+      self.session.query(Cat.age, func.count()).group_by(Cat.age),
+      self.Cat.q.with_entities(Cat.age).distinct(),
+      self.session.query(func.count(Cat.age.distinct())),
+      self.session.query(func.avg(Cat.age)),
+      self.session.query(func.max(Cat.age) - func.min(Cat.age)),
+      self.session.query(Cat.age, func.count()),
+      self.Cat.q.group_by(Cat.age).from_self(func.count()),
+    ]
+    for query in queries:
+      assert_raises(ValueError, query.all)
+    query = self.session.query(Cat.age, func.count()).group_by(Cat.age)
+    eq_(len(query.filter(Cat.owner_id == 2).all()), 6) # single shard
+    eq_(Cat.q.with_entities(Cat.age).set_shard(0).distinct().count(), 7)
+
+  def test_shared_pool(self):
+    with self.session()._get_pool() as pool:
+      pass
+    self.session.remove()
+    with self.session()._get_pool() as other_pool:
+      ok_(other_pool is pool)
+    eq_(self.Cat.q.fast_count(), 30)
+    ShardedSession.stop_pools()
+    with self.session()._get_pool() as other_pool:
+      ok_(not other_pool is pool)
+    eq_(self.Cat.q.fast_count(), 30)
+
+  def test_concurrent_fan_outs(self):
+    n_threads = 4
+    condition = Condition()
+    running = [0]
+
+    def wait_for_others(shard_id):
+      # only returns True if all items of all threads run at the same time
+      with condition:
+        running[0] += 1
+        condition.notify_all()
+        deadline = time() + 5
+        while running[0] < 3 * n_threads and time() < deadline:
+          condition.wait(deadline - time())
+        return running[0] == 3 * n_threads
+
+    results = []
+
+    def fan_out():
+      session = self.session()
+      results.extend(session.fan_out(wait_for_others, session.shard_ids))
+      self.session.remove()
+
+    threads = [Thread(target=fan_out) for _ in range(n_threads)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    eq_(results, [True] * 3 * n_threads)
+
+
+class Test_ModelsWritten(object):
+
+  def setup(self):
+    engine = create_engine('sqlite://')
+
+    # pysqlite's own transaction handling doesn't support savepoints
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+      dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+      conn.execute('BEGIN')
+
+    self.session = scoped_session(sessionmaker(bind=engine))
+    orm = ORM(self.session)
+
+    class Cat(orm.Model):
+
+      id = Column(Integer, primary_key=True)
+
+    class Dog(orm.Model):
+
+      id = Column(Integer, primary_key=True)
+
+    orm.create_all()
+    self.Cat = Cat
+    self.Dog = Dog
+    self.written = []
+    models_written.connect(self.on_write)
+
+  def teardown(self):
+    models_written.disconnect(self.on_write)
+    self.session.remove()
+
+  def on_write(self, model):
+    self.written.append(model.__name__)
+
+  def test_commit(self):
+    self.session.add(self.Cat(id=1))
+    self.session.flush()
+    eq_(self.written, ['Cat'])
+    self.session.commit()
+    eq_(self.written, ['Cat', 'Cat'])
+
+  def test_rollback(self):
+    self.session.add(self.Cat(id=1))
+    self.session.flush()
+    self.session.rollback()
+    self.session.commit()
+    eq_(self.written, ['Cat'])
+
+  def test_savepoints(self):
+    self.session.add(self.Cat(id=1))
+    self.session.flush()
+    self.session.begin_nested()
+    self.session.add(self.Dog(id=1))
+    self.session.flush()
+    self.session.rollback() # only the savepoint
+    self.session.begin_nested()
+    self.session.add(self.Dog(id=2))
+    self.session.commit() # releases the savepoint
+    eq_(self.written, ['Cat', 'Dog', 'Dog'])
+    self.session.commit()
+    eq_(sorted(self.written[3:]), ['Cat', 'Dog'])
+
+
+class Test_CacheTable(object):
+
+  def setup(self):
+    self.session = scoped_session(
+      sessionmaker(bind=create_engine('sqlite://'))
+    )
+    self.orm = ORM(self.session, persistent_cache='table')
+    self.computed = []
+
+    class Cat(self.orm.Model):
+
+      id = Column(Integer, primary_key=True)
+
+      @self.orm.Model.cached_property
+      def name(this):
+        self.computed.append(('name', this.id))
+        return u'cat%s' % (this.id, )
+
+      @self.orm.Model.cached_property
+      def friends(this):
+        self.computed.append(('friends', this.id))
+        return range(this.id)
+
+    class Owner(self.orm.Model):
+
+      name = Column(Unicode(32), primary_key=True)
+
+      @self.orm.Model.cached_property
+      def greeting(this):
+        return u'hi %s' % (this.name, )
+
+    self.orm.create_all()
+    self.session.add_all(Cat(id=index) for index in range(3))
+    self.session.add(Owner(name=u'ren\xe9'))
+    self.session.commit()
+    self.Cat = Cat
+    self.Owner = Owner
+
+  def teardown(self):
+    self.session.remove()
+
+  def get_rows(self):
+    table = self.orm._cache_table.table
+    return sorted(
+      (row.key, row.name, row.value)
+      for row in self.session.execute(table.select())
+    )
+
+  def test_deferred_writes(self):
+    cat = self.Cat.q.get(2)
+    eq_((cat.name, cat.friends), (u'cat2', [0, 1]))
+    eq_(self.get_rows(), [])
+    self.session.commit()
+    eq_(self.get_rows(), [('2', 'friends', '[0, 1]'), ('2', 'name', '"cat2"')])
+    self.session.remove()
+    cat = self.Cat.q.get(2)
+    eq_(cat.name, u'cat2')
+    eq_(len(self.computed), 2)
+    cat.refresh_cache(['name'])
+    self.session.rollback()
+    eq_(self.Cat.q.get(2).name, u'cat2')
+    eq_(len(self.computed), 3)
+
+  def test_concurrent_writes(self):
+    table = self.orm._cache_table.table
+    inserted = []
+
+    def insert_first(conn, clause, multiparams, params):
+      if isinstance(clause, Insert) and clause.table is table and not inserted:
+        # another transaction writes the same entry after the delete
+        inserted.append(True)
+        conn.execute(table.insert(), multiparams[0][0])
+
+    event.listen(self.session.get_bind(), 'before_execute', insert_first)
+    eq_(self.Cat.q.get(2).name, u'cat2')
+    self.session.commit()
+    ok_(inserted)
+    eq_(self.get_rows(), [('2', 'name', '"cat2"')])
+
+  def test_unicode_keys(self):
+    eq_(self.Owner.q.get(u'ren\xe9').greeting, u'hi ren\xe9')
+    self.session.commit()
+    eq_(self.get_rows(), [(u'ren\xe9', 'greeting', u'"hi ren\\u00e9"')])
+    eq_(self.Owner.q.get(u'ren\xe9').greeting, u'hi ren\xe9')
+    eq_(self.Owner.q.refresh_cache(expiration=60), 0)
+    eq_(self.orm.expire_cache(models=[self.Owner]), 1)
+
+  def test_expire(self):
+    for cat in self.Cat.q:
+      cat.name
+    self.Cat.q.get(1).friends
+    self.session.commit()
+    eq_(self.orm.expire_cache(names=['name']), 3)
+    eq_(self.get_rows(), [('1', 'friends', '[0]')])
+    eq_(self.Cat.q.get(0).name, u'cat0')
+    eq_(self.orm.expire_cache(max_age=60), 0)
+
+  def test_refresh_query(self):
+    eq_(self.Cat.q.refresh_cache(chunk_size=2), 3)
+    eq_(sorted(self.computed), [
+      ('friends', 0), ('friends', 1), ('friends', 2),
+      ('name', 0), ('name', 1), ('name', 2),
+    ])
+    eq_(len(self.get_rows()), 6)
+    self.session.commit()
+    self.orm.expire_cache(names=['name'])
+    self.session.commit()
+    self.computed = []
+    eq_(self.Cat.q.refresh_cache(expiration=60, chunk_size=2), 3)
+    eq_(sorted(self.computed), [('name', 0), ('name', 1), ('name', 2)])
+    self.session.commit()
+    self.computed = []
+    eq_(self.Cat.q.filter(self.Cat.id > 0).refresh_cache(['friends']), 2)
+    eq_(sorted(self.computed), [('friends', 1), ('friends', 2)])
+
+  def test_refresh_task(self):
+    celery = Celery('test')
+    celery.periodic_task = periodic_task # as on kit's Celery applications
+    task = self.orm.refresh_cache_task(
+      celery, timedelta(hours=1), name='test.refresh_cache', expiration=60
+    )
+    ok_('test.refresh_cache' in celery.tasks)
+    eq_(task.run_every, timedelta(hours=1))
+    for cat in self.Cat.q:
+      cat.name
+    self.session.commit()
+    self.computed = []
+    eq_(task(), {'Cat': 3, 'Owner': 1})
+    eq_(sorted(self.computed), [('friends', 0), ('friends', 1), ('friends', 2)])
+    eq_(len(self.get_rows()), 7)
+    self.orm.expire_cache(names=['name'])
+    self.session.commit()
+    self.computed = []
+    eq_(task(), {'Cat': 3, 'Owner': 0})
+    eq_(sorted(self.computed), [('name', 0), ('name', 1), ('name', 2)])
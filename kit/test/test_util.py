@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 
+from datetime import date
+from decimal import Decimal
 from flask import Flask
-from nose.tools import eq_, raises
+from nose import SkipTest
+from nose.tools import eq_, ok_, raises
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 
 from kit.util import *
 
@@ -61,6 +67,156 @@ class Test_Cacheable(object):
     eq_(set(self.ex.get_cache_ages().keys()), set(['number', 'another']))
 
 
+class Test_CacheBackend(object):
+
+  def setup(self):
+    self.computed = []
+
+    class Example(Cacheable):
+
+      __cache_backend__ = LRUCache(max_size=2)
+
+      def __init__(self, key):
+        self.key = key
+
+      def _get_cache_key(self):
+        return self.key
+
+      @Cacheable.cached_property
+      def number(this):
+        self.computed.append(this.key)
+        return this.key * 10
+
+    self.Example = Example
+
+  def test_shared(self):
+    eq_(self.Example(1).number, 10)
+    eq_(self.Example(1).number, 10)
+    eq_(self.computed, [1])
+    ok_(self.Example(1).__cache__ is None)
+    ok_(self.Example(2).get_cache_ages()['number'] is None)
+    self.Example(1).refresh_cache()
+    eq_(self.computed, [1, 1])
+
+  def test_stats(self):
+    keys = ['hits', 'misses', 'evictions']
+    before = self.Example.get_cache_stats()['number']
+    for key in [1, 2, 1, 3, 1]:
+      self.Example(key).number
+    stats = self.Example.get_cache_stats()['number']
+    eq_([stats[key] - before[key] for key in keys], [2, 3, 1])
+    ok_(stats['hit_rate'] > 0)
+
+  def test_sqlite(self):
+    path = mkdtemp()
+    try:
+      cache = SQLiteCache(join(path, 'cache.db'), max_entries=2)
+      cache.prune_every = 1
+      self.Example.__cache_backend__ = cache
+      eq_(self.Example(1).number, 10)
+      eq_(self.Example(1).number, 10)
+      eq_(self.computed, [1])
+      evictions = self.Example.get_cache_stats()['number']['evictions']
+      self.Example(2).number
+      self.Example(3).number
+      eq_(cache.get(self.Example.number._get_key(self.Example, 1)), None)
+      eq_(self.Example.get_cache_stats()['number']['evictions'], evictions + 1)
+      ok_(cache.set('a', 1, timeout=-1))
+      eq_(cache.get('a'), None)
+    finally:
+      rmtree(path)
+
+
+  def test_namespaces(self):
+    Example = self.Example
+
+    class Other(Cacheable):
+
+      __cache_backend__ = Example.__cache_backend__
+      __module__ = 'other'
+
+      _get_cache_key = Example._get_cache_key.im_func
+
+      def __init__(self, key):
+        self.key = key
+
+      @Cacheable.cached_property
+      def number(this):
+        return this.key * 20
+
+    Other.__name__ = 'Example' # e.g. defined in another module
+    eq_((Example(1).number, Other(1).number), (10, 20))
+    eq_(Other.get_cache_stats()['number']['misses'], 1)
+
+  def test_chained_eviction_callback(self):
+    evicted = []
+    self.Example.__cache_backend__ = LRUCache(
+      max_size=1, on_evict=evicted.append
+    )
+    evictions = self.Example.get_cache_stats()['number']['evictions']
+    for key in [1, 2, 3]:
+      self.Example(key).number
+    eq_(len(evicted), 2)
+    eq_(self.Example.get_cache_stats()['number']['evictions'], evictions + 2)
+
+
+def test_lru_cache():
+  cache = LRUCache(max_size=10, sizeof=len)
+  cache.set('a', 'abcd')
+  cache.set('b', 'efgh')
+  eq_(cache.get('a'), 'abcd') # b is now the least recently used
+  cache.set('c', 'ijkl')
+  eq_(cache.get('b'), None)
+  eq_((cache.size, cache.evictions, cache.hits, cache.misses), (8, 1, 1, 1))
+  ok_(not cache.set('d', 'a' * 11))
+  cache.set('a', 'z', timeout=-1)
+  eq_(cache.get('a'), None)
+  eq_(len(cache), 1)
+
+def test_metrics():
+  metrics = Metrics(buckets=(0.1, 1))
+  metrics.increment('jobs_total', queue='a')
+  metrics.increment('jobs_total', 2, queue='a')
+  for value in [0.05, 0.5, 5]:
+    metrics.observe('job_seconds', value)
+  metrics.register('queue_size', lambda: [({'queue': 'a"b'}, 4)])
+  eq_(
+    metrics.to_json()['jobs_total'],
+    [{'labels': {'queue': 'a'}, 'value': 3}]
+  )
+  eq_(metrics.to_prometheus().splitlines(), [
+    '# TYPE jobs_total counter',
+    'jobs_total{queue="a"} 3',
+    '# TYPE job_seconds histogram',
+    'job_seconds_bucket{le="0.1"} 1',
+    'job_seconds_bucket{le="1.0"} 2',
+    'job_seconds_bucket{le="+Inf"} 3',
+    'job_seconds_sum 5.55',
+    'job_seconds_count 3',
+    '# TYPE queue_size gauge',
+    'queue_size{queue="a\\"b"} 4',
+  ])
+
+def test_metrics_pool():
+  from sqlalchemy import create_engine
+  from sqlalchemy.pool import QueuePool
+  metrics = Metrics()
+  engine = create_engine('sqlite://', poolclass=QueuePool, pool_size=2)
+  metrics.watch_pool(engine.pool, session='db')
+  connection = engine.connect()
+  values = dict(
+    (name, samples[0][1]) for name, _, samples in metrics.collect()
+  )
+  eq_(values['kit_pool_checkout_seconds']['count'], 1)
+  eq_(values['kit_pool_connections_in_use'], 1)
+  eq_(values['kit_pool_size'], 2)
+  connection.close()
+  metrics.watch_pool(engine.pool.recreate(), session='db') # e.g. after fork
+  samples = dict((name, samples) for name, _, samples in metrics.collect())
+  eq_(samples['kit_pool_connections_in_use'], [({'session': 'db'}, 0)])
+  metrics.clear()
+  ok_(not 'kit_pool_checkout_seconds' in metrics.to_json())
+
 def test_to_json():
 
   class Foo(Jsonifiable):
@@ -80,6 +236,32 @@ def test_to_json():
   Foo.__json__ = ['n']
   eq_(foo.to_json(depth=2), {'n': 0})
 
+def test_json_converters():
+
+  class Price(Decimal):
+    pass
+
+  eq_(
+    to_json([date(2013, 5, 1), set([1]), Price('1.5')]),
+    ['2013-05-01', [1], 1.5]
+  )
+  register_json_converter(Decimal)(lambda value, depth: str(value))
+  try:
+    eq_(to_json({'price': Price('1.50')}), {'price': '1.50'})
+  finally:
+    register_json_converter(Decimal)(lambda value, depth: float(value))
+  raises(ValueError)(to_json)(object())
+
+def test_json_converters_pandas():
+  try:
+    from numpy import array, float64
+    from pandas import DataFrame
+  except ImportError:
+    raise SkipTest
+  eq_(to_json(array([[1, 2]])), [[1, 2]])
+  ok_(isinstance(to_json(float64(2.5)), float))
+  eq_(to_json(DataFrame({'a': [1, 2]})), [{'a': 1}, {'a': 2}])
+
 
 class Test_View(object):
 